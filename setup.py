@@ -10,7 +10,7 @@ setup(
         long_description = "Check the GitHub homepage for getting started", # TODO: add DESCRIPTION.txt that is excluded
         license ='MIT',
         package_dir={"": "src"},
-        py_modules=["app","controller","imageresource"],
+        py_modules=["app","batch","controller","imageresource"],
         packages=["ui","processing"],
         #include_package_data=True,
         #package_data={'src/images': ['images/*.png']},
@@ -26,7 +26,8 @@ setup(
         ], 
         entry_points ={ 
             'console_scripts': [ 
-                'pylidartracker = app:main'
+                'pylidartracker = app:main',
+                'pylidartracker-batch = batch:main'
             ] 
         },
         classifiers=[
@@ -0,0 +1,104 @@
+import sys
+import os
+import json
+import time
+import argparse
+
+from processing.lidarprocessor import LidarProcessor
+from processing.outputwritter import OutputWriter
+
+def needs_preview_frames(config):
+    # background is extracted from loaded frames if it can not be loaded,
+    # streaming extraction reads the pcap file itself
+    background = config.get("background", {})
+    path = background.get("path", "")
+    if "extractor" not in background or (path and os.path.exists(path)):
+        return False
+    return background["extractor"].get("method") != "range_image_stream"
+
+def run(pcap, config_path, output, output_format="json", from_frame=0,
+    to_frame=None, workers=1, chunk_size=20, quiet=False, trust_bg_index=False):
+    with open(config_path, "r") as read_file:
+        config = json.load(read_file)
+
+    model = LidarProcessor()
+    model.trustBgIndex = trust_bg_index
+    model.setFilename(pcap)
+    n_frames = model.peek_size()
+    if to_frame is None or to_frame > n_frames - 1:
+        to_frame = n_frames - 1
+
+    if needs_preview_frames(config):
+        n_preview = config["background"]["extractor"]["params"].get("n_frames", 100)
+        model.restartBuffering()
+        model.loadNFrames(min(n_preview, n_frames))
+
+    model.init_from_config(config_path)
+    if model.clusterer is None or model.tracker is None:
+        raise ValueError("Config must define clustering and tracking", config_path)
+
+    writer = OutputWriter(output, outputFormat=output_format)
+    start = time.time()
+    count = 0
+    try:
+        for (n, ts, clusters, p) in model.processingGen(from_frame, to_frame,
+            workers=workers, chunk_size=chunk_size):
+            writer.add(n, ts, clusters)
+            count += 1
+            if not quiet:
+                elapsed = time.time() - start
+                sys.stderr.write("\rframe {} of {} [{:5.1f}%] {:6.1f} frames/s".format(
+                    n, to_frame, p, count / elapsed if elapsed > 0 else 0))
+                sys.stderr.flush()
+    finally:
+        writer.close()
+
+    elapsed = time.time() - start
+    fps = count / elapsed if elapsed > 0 else 0
+    if not quiet:
+        sys.stderr.write("\n")
+    sys.stderr.write("Processed {} frames in {:.1f} s ({:.1f} frames/s), output saved to:\n{}\n".format(
+        count, elapsed, fps, output))
+    return count, elapsed
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Apply a saved project config to a pcap file without the UI")
+    ap.add_argument("pcap",
+        help="Path to the pcap file")
+    ap.add_argument("config",
+        help="Path to JSON project config file")
+    ap.add_argument("output",
+        help="Path to the output file")
+    ap.add_argument("-f", "--format", default="json", choices=["json", "csv"],
+        help="Output file format")
+    ap.add_argument("--from-frame", default=0, type=int,
+        help="First frame to process")
+    ap.add_argument("--to-frame", default=None, type=int,
+        help="Last frame to process, defaults to the last frame of the file")
+    ap.add_argument("-w", "--workers", default=1, type=int,
+        help="Number of worker processes, 0 uses all cores")
+    ap.add_argument("--chunk-size", default=20, type=int,
+        help="Frames per worker task")
+    ap.add_argument("-q", "--quiet", action="store_true",
+        help="Do not report progress")
+    ap.add_argument("--trust-bg-index", action="store_true",
+        help="Load the pickled <background>.tree.pkl index saved next to the "
+        "background CSV, only use with files from a trusted source")
+    args = ap.parse_args()
+
+    try:
+        run(args.pcap, args.config, args.output,
+            output_format=args.format,
+            from_frame=args.from_frame,
+            to_frame=args.to_frame,
+            workers=args.workers if args.workers > 0 else None,
+            chunk_size=args.chunk_size,
+            quiet=args.quiet,
+            trust_bg_index=args.trust_bg_index)
+    except (OSError, ValueError) as e:
+        sys.stderr.write("Error: {}\n".format(e))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -241,20 +241,17 @@ class Controller():
         self.updateGraphicsView()
 
     def load_frames_fn(self, from_frame, to_frame, progress_callback):
-        self._model.restartBuffering()
+        # seeks straight to from_frame using the frame index
+        self._model.restartBuffering(from_frame)
         self._model.resetFrameData()
-        for n in range(to_frame):
-            if n < from_frame:
-                self._model.readNextFrame()
-            else:
-                self._model.loadFrame()
-
-            progress_callback.emit((n+1)*100/(to_frame))
+        n_frames = to_frame - from_frame
+        for n in range(n_frames):
+            self._model.loadFrame()
+            progress_callback.emit((n+1)*100/(n_frames))
 
     # output
 
     def generate_output_fn(self, start_frame, end_frame, progress_callback):
-        self._model.restartBuffering()
         for (n, ts, clusters, p) in self._model.processingGen(start_frame, end_frame):
             self.outputWritter.add(n, ts, clusters)
             progress_callback.emit(p)
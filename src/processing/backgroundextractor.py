@@ -1,13 +1,65 @@
 import numpy as np
-from copy import deepcopy
+from .dataentities import Frame
+
+class P2Quantile:
+    """
+    P-square estimate (Jain and Chlamtac, 1985) of the quantile p of many
+    streams at once, one stream per column of the observations. Keeps five
+    markers per stream instead of the observations themselves.
+    """
+    def __init__(self, p, first):
+        # first: (5, n_streams) initial observations
+        self.p = p
+        self.q = np.sort(first, axis=0).astype(np.float64)
+        self.n = np.tile(np.arange(1, 6, dtype=np.float64)[:,None],
+            (1, self.q.shape[1]))
+        self.desired = np.array([1, 1 + 2*p, 1 + 4*p, 3 + 2*p, 5])
+        self.increment = np.array([0, p/2, p, (1 + p)/2, 1])
+
+    def update(self, x):
+        q, n = self.q, self.n
+
+        # extend the extreme markers, shift the positions of markers above x
+        np.minimum(q[0], x, out=q[0])
+        np.maximum(q[4], x, out=q[4])
+        n[1:4] += x < q[1:4]
+        n[4] += 1
+        self.desired += self.increment
+
+        # move the middle markers towards their desired positions
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            up = (d >= 1) & (n[i+1] - n[i] > 1)
+            down = (d <= -1) & (n[i-1] - n[i] < -1)
+            s = up.astype(np.float64) - down
+            move = up | down
+            if not move.any():
+                continue
+
+            # piecewise parabolic prediction, linear if it breaks the order
+            parabolic = q[i] + s / (n[i+1] - n[i-1]) * (
+                (n[i] - n[i-1] + s) * (q[i+1] - q[i]) / (n[i+1] - n[i]) +
+                (n[i+1] - n[i] - s) * (q[i] - q[i-1]) / (n[i] - n[i-1]))
+            linear = np.where(s > 0,
+                q[i] + (q[i+1] - q[i]) / (n[i+1] - n[i]),
+                q[i] - (q[i] - q[i-1]) / (n[i] - n[i-1]))
+            ordered = (q[i-1] < parabolic) & (parabolic < q[i+1])
+            q[i] = np.where(move, np.where(ordered, parabolic, linear), q[i])
+            n[i] += s
+
+    def get(self):
+        return self.q[2]
 
 class BackgroundExtractor:
-    def __init__(self, percentile=0.80, non_zero=0.70, n_frames=100, cartesian=False):
+    def __init__(self, percentile=0.80, non_zero=0.70, n_frames=100, cartesian=False,
+        warmup=10):
         self.numScanLines = 32
         self.percentile = percentile
         self.non_zero = non_zero
-        self.n_frames = n_frames # TODO: NOT USED!!!
+        self.n_frames = n_frames # frames used by extract_stream
         self.cartesian = cartesian
+        self.warmup = warmup # frames buffered by extract_stream to size the image
+        self.method = "range_image"
         self.background = None
 
     def reshape2scanlines(self, arr):
@@ -15,11 +67,12 @@ class BackgroundExtractor:
         return newSize, arr.reshape(newSize)
         
     def extract(self, frames):
+        self.method = "range_image"
         rangeImgs = []
         newSizes = []
-        # Prepare range images
+        # Prepare range images of raw distances
         for f in frames:
-            newSize, rangeImg = self.reshape2scanlines(f.distance)
+            newSize, rangeImg = self.reshape2scanlines(f.rawDistance)
             rangeImgs.append(rangeImg)            
             newSizes.append(newSize[0])
 
@@ -42,43 +95,92 @@ class BackgroundExtractor:
         zeroMask = nonZero < len(frames)*(self.non_zero)
         bgDist[zeroMask] = 0
 
-        # Convert from spherical to cartesian coordinates
-        bgFrame = deepcopy(frames[1])
-        bgFrame.distance = bgDist.flatten()
-
-        # Reshape azimuth and elevation arrays in accordance with size of distance array
-        bgFrame.azimuth = self.reshape2scanlines(bgFrame.azimuth)[1]
-        bgFrame.azimuth = bgFrame.azimuth[:imgHeight,:].flatten()
-        bgFrame.elevation = self.reshape2scanlines(bgFrame.elevation)[1]
-        bgFrame.elevation = bgFrame.elevation[:imgHeight,:].flatten()
+        self.set_background(frames[1], imgHeight, bgDist)
 
-        bgFrame.intensity = self.reshape2scanlines(bgFrame.intensity)[1]
-        bgFrame.intensity = bgFrame.intensity[:imgHeight,:].flatten()
-        bgFrame.id = self.reshape2scanlines(bgFrame.id)[1]
-        bgFrame.id = bgFrame.id[:imgHeight,:].flatten()
-
-        bgFrame.aziRad = np.deg2rad(bgFrame.azimuth)
-        bgFrame.eleRad = np.deg2rad(bgFrame.elevation)
+    def set_background(self, ref, imgHeight, bgDist):
+        # Background frame takes laser ids and azimuths of a reference frame,
+        # distances are rounded to the sensor resolution
+        n = imgHeight * self.numScanLines
+        bgFrame = Frame(
+            laser=ref.laser[:n],
+            azimuth=ref.rawAzimuth[:n],
+            distance=np.round(bgDist.flatten()),
+            intensity=ref.intensity[:n])
         
         if self.cartesian:
             # Convert to cartesian coordinates
-
-            x = (bgFrame.distance * np.cos(eleRad) * np.sin(aziRad))
-            y = (bgFrame.distance * np.cos(eleRad) * np.cos(aziRad))
-            z = (bgFrame.distance * np.sin(eleRad))
-
-            data = np.vstack((x,y,z)).astype(np.float32).T
+            x, y, z = bgFrame.getCartesian(np.float32)
+            data = np.vstack((x,y,z)).T
             self.background = data
         else:
             self.background = bgFrame
 
+    def extract_stream(self, frames):
+        """
+        Extracts the background from up to n_frames frames of an iterator,
+        one frame at a time. The percentile of every range image cell is
+        estimated with a P-square sketch, so memory does not grow with the
+        number of frames. The image height and the reference frame are
+        taken from the first warmup frames.
+        """
+        self.method = "range_image_stream"
+        frames = iter(frames)
+
+        # buffer a few frames to size the range image
+        warmup = []
+        for f in frames:
+            warmup.append(f)
+            if len(warmup) >= min(self.warmup, self.n_frames):
+                break
+        if len(warmup) < 5 or self.n_frames <= len(warmup):
+            # too few frames for the sketch, compute the exact percentile
+            self.extract(warmup)
+            self.method = "range_image_stream"
+            return
+
+        # the first frame usually starts mid rotation, size by the others
+        imgHeight = int(np.percentile(
+            [len(f.rawDistance) // self.numScanLines for f in warmup[1:]], 5))
+        n = imgHeight * self.numScanLines
+        ref = warmup[1]
+
+        def images():
+            for f in warmup:
+                yield f
+            for _, f in zip(range(self.n_frames - len(warmup)), frames):
+                yield f
+
+        sketch = None
+        first = []
+        nonZero = np.zeros((n,), dtype=np.int64)
+        count = 0
+        for f in images():
+            count += 1
+            if len(f.rawDistance) < n:
+                continue
+            dist = f.rawDistance[:n]
+            nonZero += dist != 0
+            if sketch is None:
+                first.append(dist)
+                if len(first) == 5:
+                    sketch = P2Quantile(self.percentile, np.vstack(first))
+            else:
+                sketch.update(dist)
+
+        if sketch is None:
+            bgDist = np.percentile(np.vstack(first), self.percentile * 100, axis=0)
+        else:
+            bgDist = sketch.get()
+        bgDist = np.clip(bgDist, 0, None)
+        bgDist[nonZero < count * self.non_zero] = 0
+        self.set_background(ref, imgHeight, bgDist.reshape(imgHeight, self.numScanLines))
 
     def get_background(self):
         return self.background
 
     def get_config(self):
         return {
-            "method": "range_image", 
+            "method": self.method,
             "params": {
                 "percentile": self.percentile,
                 "non_zero": self.non_zero,
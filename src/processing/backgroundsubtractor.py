@@ -1,6 +1,9 @@
+import hashlib
+import pickle
 import numpy as np
 from scipy.spatial import cKDTree
 from sklearn.neighbors import BallTree
+from .dataentities import Packet
 
 class BackgroundSubtractor():
     @staticmethod
@@ -9,10 +12,18 @@ class BackgroundSubtractor():
             return KDTreeSubtractor(**kwargs)
         elif method == "octree":
             return OctreeSubtractor(**kwargs)
+        elif method == "range_image":
+            return RangeImageSubtractor(**kwargs)
+        elif method == "voxel":
+            return VoxelSubtractor(**kwargs)
+        elif method == "adaptive_range_image":
+            return AdaptiveRangeImageSubtractor(**kwargs)
         else:
             ValueError(method)
 
 class OctreeSubtractor():
+    sensor_space = False
+
     def __init__(self, bg_cloud, resolution):
         self.bg = bg_cloud
         self.bgTree = BallTree(bg_cloud.to_array(), leaf_size=10)
@@ -48,22 +59,74 @@ class OctreeSubtractor():
             }
 
 class KDTreeSubtractor():
+    sensor_space = False
+
     def __init__(self, bg_cloud=None, search_radius=0.1):
         self.bg_cloud = bg_cloud
-        
+        self.search_radius = search_radius
+
         self.bgTree = None
+        self.digest = None
         if self.bg_cloud is not None:
-            self.bgTree = BallTree(bg_cloud, leaf_size=10)
+            self.set_background(bg_cloud)
 
-        self.search_radius = search_radius
+    @staticmethod
+    def background_digest(bg_cloud):
+        # content hash identifying the cloud a tree was built from
+        bg_cloud = np.ascontiguousarray(bg_cloud)
+        h = hashlib.sha1(str((bg_cloud.dtype.str, bg_cloud.shape)).encode())
+        h.update(bg_cloud.data)
+        return h.hexdigest()
 
     def set_background2(self, bg_cloud):
         self.bg_cloud = bg_cloud
         self.bgTree = cKDTree(bg_cloud)
 
     def set_background(self, bg_cloud):
+        # the tree is only rebuilt if the background cloud has changed
+        digest = KDTreeSubtractor.background_digest(bg_cloud)
         self.bg_cloud = bg_cloud
-        self.bgTree = BallTree(bg_cloud, leaf_size=10)
+        if self.bgTree is None or digest != self.digest:
+            self.bgTree = BallTree(bg_cloud, leaf_size=10)
+            self.digest = digest
+
+    def get_index(self):
+        return self.digest, self.bgTree
+
+    def set_index(self, digest, tree):
+        # reuse a tree built earlier, set_background keeps it
+        # as long as the background cloud has the same digest
+        self.digest = digest
+        self.bgTree = tree
+
+    @staticmethod
+    def index_path(bg_file):
+        return bg_file + ".tree.pkl"
+
+    def save_index(self, bg_file):
+        """
+        Pickles the tree next to the background CSV, returns False if the
+        file could not be written
+        """
+        if self.bgTree is None:
+            return False
+        try:
+            with open(KDTreeSubtractor.index_path(bg_file), "wb") as f:
+                pickle.dump(self.get_index(), f, pickle.HIGHEST_PROTOCOL)
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def load_index(bg_file):
+        # returns (digest, tree) saved next to the background CSV or None,
+        # the file is unpickled so only load it from a trusted source
+        try:
+            with open(KDTreeSubtractor.index_path(bg_file), "rb") as f:
+                digest, tree = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+        return digest, tree
 
     def subtract2(self, arr):
         arrayTree = cKDTree(arr)
@@ -87,3 +150,250 @@ class KDTreeSubtractor():
                 "search_radius": self.search_radius
                 }
             }
+
+class RangeImageSubtractor():
+    """
+    Subtracts the background in range image space. Every return is looked
+    up by laser id and azimuth bin and kept as foreground unless its
+    distance lies within tolerance of the background distances of that
+    cell. Works on points in sensor coordinates, before any transform.
+    """
+    sensor_space = True
+
+    def __init__(self, tolerance=0.2, azimuth_resolution=0.2):
+        self.tolerance = tolerance
+        self.azimuth_resolution = azimuth_resolution
+        self.n_bins = int(np.ceil(360 / azimuth_resolution))
+        self.near = None
+        self.far = None
+
+        # laser ids ordered by elevation for nearest elevation lookup
+        order = np.argsort(Packet.eleLut)
+        sinEle = np.sin(np.deg2rad(Packet.eleLut[order]))
+        self._laserOrder = order
+        self._sinEleEdges = (sinEle[1:] + sinEle[:-1]) / 2
+
+    def azimuth_bins(self, azimuth):
+        # azimuth in degrees to bin index
+        return (azimuth / self.azimuth_resolution).astype(np.int64) % self.n_bins
+
+    def frame_cells(self, frame):
+        # laser ids, azimuth bins and distances of the returns of a frame
+        valid = frame.rawDistance != 0
+        laser = frame.laser[valid].astype(np.int64)
+        bins = self.azimuth_bins(frame.rawAzimuth[valid] / 100)
+        distance = frame.distance[valid].astype(np.float32)
+        return laser, bins, distance
+
+    def set_background_frame(self, frame):
+        laser, bins, distance = self.frame_cells(frame)
+
+        # closest and farthest background return of every cell
+        near = np.full((Packet.lasers, self.n_bins), np.inf, dtype=np.float32)
+        far = np.full((Packet.lasers, self.n_bins), -np.inf, dtype=np.float32)
+        np.minimum.at(near, (laser, bins), distance)
+        np.maximum.at(far, (laser, bins), distance)
+        self.set_bands(near, far)
+
+    def set_bands(self, near, far):
+        # dilate by one azimuth bin to absorb jitter of the firing azimuths
+        self.near = np.minimum(near, np.minimum(
+            np.roll(near, 1, axis=1), np.roll(near, -1, axis=1)))
+        self.far = np.maximum(far, np.maximum(
+            np.roll(far, 1, axis=1), np.roll(far, -1, axis=1)))
+
+    def cells(self, arr):
+        """
+        Returns laser ids, azimuth bins and distances of sensor
+        coordinate points
+        """
+        distance = np.sqrt(np.einsum("ij,ij->i", arr, arr))
+        azimuth = np.degrees(np.arctan2(arr[:,0], arr[:,1])) % 360
+        laser = self._laserOrder[
+            np.searchsorted(self._sinEleEdges, arr[:,2] / distance)]
+        return laser, self.azimuth_bins(azimuth), distance
+
+    def subtract(self, arr):
+        if arr.size == 0 or self.near is None:
+            return arr
+
+        laser, bins, distance = self.cells(arr)
+        near = self.near[laser, bins]
+        far = self.far[laser, bins]
+        background = (distance >= near - self.tolerance) & \
+            (distance <= far + self.tolerance)
+        return arr[~background]
+
+    def get_config(self):
+        return {
+            "method": "range_image",
+            "params": {
+                "tolerance": self.tolerance,
+                "azimuth_resolution": self.azimuth_resolution
+                }
+            }
+
+class VoxelSubtractor():
+    """
+    Subtracts the background by voxel occupancy. Background points are
+    quantized into voxels of the given resolution and dilated by one voxel
+    in every direction. The occupied voxels are stored as a bit grid over
+    their bounding box, frame points falling into an occupied voxel are
+    removed with a single lookup each. Backgrounds whose bounding box has
+    more than max_cells voxels are stored as sorted int64 keys instead.
+    """
+    sensor_space = False
+    bits = 21 # bits per packed coordinate
+    offset = 1 << (bits - 1)
+    max_cells = 1 << 28 # voxels of the bit grid, 32 MB
+
+    def __init__(self, bg_cloud=None, resolution=0.2):
+        self.resolution = resolution
+        self.keys = np.zeros((0,), dtype=np.int64)
+        self.grid = None
+        self.origin = None
+        self.shape = None
+        if bg_cloud is not None:
+            self.set_background(bg_cloud)
+
+    def voxels(self, arr):
+        return np.floor(arr / self.resolution).astype(np.int64)
+
+    def pack(self, voxels):
+        v = voxels + VoxelSubtractor.offset
+        return (v[:,0] << (2 * VoxelSubtractor.bits)) | \
+            (v[:,1] << VoxelSubtractor.bits) | v[:,2]
+
+    def set_background(self, bg_cloud):
+        self.keys = np.zeros((0,), dtype=np.int64)
+        self.grid = None
+        voxels = np.unique(self.voxels(bg_cloud), axis=0)
+        if voxels.size == 0:
+            return
+
+        neighbours = np.array(np.meshgrid(
+            [-1,0,1], [-1,0,1], [-1,0,1], indexing="ij")).reshape(3,-1).T
+        dilated = (voxels[:,None,:] + neighbours[None,:,:]).reshape(-1,3)
+
+        origin = dilated.min(axis=0)
+        shape = dilated.max(axis=0) - origin + 1
+        if np.prod(shape) > VoxelSubtractor.max_cells:
+            self.keys = np.unique(self.pack(dilated))
+            return
+
+        v = dilated - origin
+        cells = (v[:,0] * shape[1] + v[:,1]) * shape[2] + v[:,2]
+        self.grid = np.zeros(((int(np.prod(shape)) + 7) // 8,), dtype=np.uint8)
+        np.bitwise_or.at(self.grid, cells >> 3,
+            np.left_shift(1, cells & 7).astype(np.uint8))
+        self.origin = origin
+        self.shape = shape
+
+    def occupied(self, arr):
+        if self.grid is None:
+            keys = self.pack(self.voxels(arr))
+            idx = np.searchsorted(self.keys, keys)
+            idx[idx == self.keys.size] = 0
+            return self.keys[idx] == keys
+
+        # negative offsets wrap to large unsigned values and fail the bounds
+        v = (self.voxels(arr) - self.origin).view(np.uint64)
+        shape = self.shape.astype(np.uint64)
+        inside = (v[:,0] < shape[0]) & (v[:,1] < shape[1]) & (v[:,2] < shape[2])
+        cells = np.where(inside, (v[:,0] * shape[1] + v[:,1]) * shape[2] + v[:,2], 0)
+        bit = (self.grid[cells >> np.uint64(3)] >> (cells & np.uint64(7)).astype(np.uint8)) & 1
+        return inside & bit.astype(bool)
+
+    def subtract(self, arr):
+        if arr.size == 0 or (self.grid is None and self.keys.size == 0):
+            return arr
+        return arr[np.flatnonzero(~self.occupied(arr))]
+
+    def get_config(self):
+        return {
+            "method": "voxel",
+            "params": {
+                "resolution": self.resolution
+                }
+            }
+
+class AdaptiveRangeImageSubtractor(RangeImageSubtractor):
+    """
+    Range image subtractor whose background keeps learning during a
+    processing run. Every cell holds a stochastic estimate of the given
+    quantile of its farthest return and an exponential moving average of
+    how often it returns at all, so parked cars become background and
+    cells that stop returning are dropped. Each update is O(cells) and no
+    frame history is kept.
+    """
+    def __init__(self, tolerance=0.2, azimuth_resolution=0.2, quantile=0.9,
+        step=0.05, occupancy_rate=0.01, min_occupancy=0.05):
+        super().__init__(tolerance, azimuth_resolution)
+        self.quantile = quantile
+        self.step = step # meters the estimate moves per frame
+        self.occupancy_rate = occupancy_rate
+        self.min_occupancy = min_occupancy
+        self.bgFrame = None
+        self.level = None
+        self.occupancy = None
+
+    def set_background_frame(self, frame):
+        self.bgFrame = frame
+        self.restart()
+
+    def restart(self):
+        # start over from the initial background frame
+        shape = (Packet.lasers, self.n_bins)
+        self.level = np.full(shape, np.nan, dtype=np.float32)
+        self.occupancy = np.zeros(shape, dtype=np.float32)
+        if self.bgFrame is not None:
+            laser, bins, distance = self.frame_cells(self.bgFrame)
+            np.fmax.at(self.level, (laser, bins), distance)
+            self.occupancy[~np.isnan(self.level)] = 1
+        self.update_bands()
+
+    def update_bands(self):
+        background = self.occupancy >= self.min_occupancy
+        self.set_bands(
+            np.where(background, self.level, np.inf),
+            np.where(background, self.level, -np.inf))
+
+    def update(self, arr):
+        """
+        Updates the background with all sensor coordinate points
+        of a frame
+        """
+        if self.level is None:
+            return
+
+        # farthest return of every cell in this frame
+        observed = np.full(self.level.shape, np.nan, dtype=np.float32)
+        if arr.size:
+            laser, bins, distance = self.cells(arr)
+            np.fmax.at(observed, (laser, bins), distance)
+        hit = ~np.isnan(observed)
+
+        # cells seen for the first time start at the observed distance
+        new = hit & np.isnan(self.level)
+        self.level[new] = observed[new]
+
+        with np.errstate(invalid="ignore"):
+            above = observed > self.level
+            below = observed < self.level
+        self.level[above] += self.step * self.quantile
+        self.level[below] -= self.step * (1 - self.quantile)
+        self.occupancy += self.occupancy_rate * (hit - self.occupancy)
+        self.update_bands()
+
+    def get_config(self):
+        return {
+            "method": "adaptive_range_image",
+            "params": {
+                "tolerance": self.tolerance,
+                "azimuth_resolution": self.azimuth_resolution,
+                "quantile": self.quantile,
+                "step": self.step,
+                "occupancy_rate": self.occupancy_rate,
+                "min_occupancy": self.min_occupancy
+                }
+            }
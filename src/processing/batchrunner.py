@@ -0,0 +1,76 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from .pcapframeparser import PcapFrameParser
+
+# processor holding the stages of the pipeline inside each worker process
+_processor = None
+
+def _init_worker(processor):
+    global _processor
+    _processor = processor
+
+def _process_chunk(start_frame, count):
+    """
+    Runs every stage before tracking on count frames from start_frame,
+    frames are read by seeking through the frame index
+    """
+    parser = PcapFrameParser(_processor.filename, use_mmap=True,
+        frame_index=_processor.frameIndex)
+    frames = parser.generator(start_frame=start_frame)
+
+    results = []
+    for i, (ts, frame) in zip(range(start_frame, start_frame + count), frames):
+        pts = _processor.arrayFromFrame(frame, prefilter=True)
+        pts = _processor.preprocessArray(pts)
+        clusters = _processor.clusterer.cluster(pts)
+        results.append((i, ts, clusters))
+    return results
+
+class BatchRunner:
+    """
+    Fans the per frame stages of LidarProcessor.processingGen out to a
+    process pool in ordered chunks, tracking stays sequential in the
+    calling process so the output matches the serial path
+    """
+    def __init__(self, processor, workers=None, chunk_size=20):
+        self.processor = processor
+        self.workers = workers if workers else os.cpu_count()
+        self.chunk_size = chunk_size
+
+    def run(self, start_frame, end_frame):
+        processor = self.processor
+        if processor.clusterer is None or processor.tracker is None:
+            return
+
+        # workers seek through the index, make sure it exists
+        if processor.frameIndex is None:
+            processor.peek_size()
+        processor.updateBackground()
+        end_frame = min(end_frame, len(processor.frameIndex) - 1)
+
+        chunks = deque(
+            (s, min(self.chunk_size, end_frame + 1 - s))
+            for s in range(start_frame, end_frame + 1, self.chunk_size))
+
+        processor.tracker.restart()
+        with ProcessPoolExecutor(max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(processor.stagesCopy(),)) as pool:
+
+            # keep a bounded number of chunks in flight, consume in order
+            pending = deque()
+            while chunks and len(pending) < 2 * self.workers:
+                pending.append(pool.submit(_process_chunk, *chunks.popleft()))
+
+            while pending:
+                results = pending.popleft().result()
+                if chunks:
+                    pending.append(pool.submit(_process_chunk, *chunks.popleft()))
+
+                for (i, ts, clusters) in results:
+                    processor.trackClusters(clusters)
+
+                    # output frame number, time, tracked clusters and progress
+                    p = (i-start_frame+1)*100/(end_frame - start_frame + 1)
+                    yield (i, ts, clusters, p)
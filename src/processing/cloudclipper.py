@@ -1,6 +1,41 @@
 import numpy as np
 from skimage.measure import points_in_poly
 
+# degrees added to both ends of a prefilter azimuth sector
+PREFILTER_MARGIN = 0.1
+
+def prism_prefilter(polygon, z_range, transformer=None):
+    """
+    Returns the azimuth sector (start, stop) in degrees, or None if every
+    azimuth is needed, and the largest distance from the sensor of a prism
+    given by a polygon in XY and a z range in the transformed coordinates.
+    Returns None if the prism is not bounded.
+    """
+    if z_range[0] == z_range[1]:
+        return None
+    polygon = np.asarray(polygon, dtype=np.float64)
+    corners = np.vstack((
+        np.column_stack((polygon, np.full(len(polygon), z_range[0]))),
+        np.column_stack((polygon, np.full(len(polygon), z_range[1])))))
+    if transformer is not None:
+        corners = transformer.inverse_transform(corners)
+
+    # the farthest point of the convex hull of the corners is a corner
+    margin = 0.01
+    max_distance = np.linalg.norm(corners, axis=1).max() * (1 + margin) + margin
+
+    # the corners span a sector if the sensor sees them within less than
+    # a half turn, that is if the largest gap between them is over 180 deg
+    azimuth = np.sort(np.degrees(np.arctan2(corners[:,0], corners[:,1])) % 360)
+    gaps = np.diff(np.append(azimuth, azimuth[0] + 360))
+    k = np.argmax(gaps)
+    sector = None
+    if gaps[k] > 180 + 2 * PREFILTER_MARGIN:
+        start = (azimuth[(k + 1) % len(azimuth)] - PREFILTER_MARGIN) % 360
+        stop = (azimuth[k] + PREFILTER_MARGIN) % 360
+        sector = (start, stop)
+    return sector, max_distance
+
 class CloudClipper():
     @staticmethod
     def factory(method, **kwargs):
@@ -14,6 +49,11 @@ class CloudClipper():
             ValueError(method)
 
 class PolarClipper():
+    """
+    Keeps points within an azimuth range, an elevation range (fov), a
+    distance range and a z range. Ranges with equal ends are not applied,
+    the azimuth range wraps through 0 if its start is above its end.
+    """
     def __init__(self, azimuth_range, 
         fov, distance_range, z_range, inverse=False):
         self.azimuth_range = azimuth_range
@@ -22,12 +62,51 @@ class PolarClipper():
         self.z_range = z_range
         self.inverse = inverse
 
+    def mask(self, data):
+        x, y, z = data[:,0], data[:,1], data[:,2]
+        mask = np.full((data.shape[0], ), True)
+
+        if self.z_range[0] != self.z_range[1]:
+            mask &= (z > self.z_range[0]) & (z < self.z_range[1])
+
+        planar = np.hypot(x, y)
+        if self.distance_range[0] != self.distance_range[1]:
+            distance = np.hypot(planar, z)
+            mask &= (distance > self.distance_range[0]) & \
+                (distance < self.distance_range[1])
+
+        if self.fov[0] != self.fov[1]:
+            elevation = np.degrees(np.arctan2(z, planar))
+            mask &= (elevation > self.fov[0]) & (elevation < self.fov[1])
+
+        if self.azimuth_range[0] != self.azimuth_range[1]:
+            # azimuth is measured clockwise from y like the sensor does
+            azimuth = np.degrees(np.arctan2(x, y)) % 360
+            start, stop = self.azimuth_range[0] % 360, self.azimuth_range[1] % 360
+            if start < stop:
+                mask &= (azimuth > start) & (azimuth < stop)
+            else:
+                mask &= (azimuth > start) | (azimuth < stop)
+
+        # apply inversion if required
+        if self.inverse:
+            mask = np.invert(mask)
+        return mask
+
     def clip(self, data):
-        # Not implemented
-        return data
+        return data[self.mask(data)]
 
     def get_config(self):
-        return {}
+        return {
+            "method": "polar",
+            "params": {
+                "azimuth_range": list(self.azimuth_range),
+                "fov": list(self.fov),
+                "distance_range": list(self.distance_range),
+                "z_range": list(self.z_range),
+                "inverse": self.inverse
+                }
+            }
 
 class CartesianClipper():
     def __init__(self, x_range, y_range,
@@ -38,23 +117,39 @@ class CartesianClipper():
         self.z_range = z_range
         self.inverse = inverse
 
-    def clip(self, data):
-        # verify that data is 3D
-
+    def mask(self, data):
         # calculate masks for inliers in x, y and z ranges 
-        x_mask = (data[:,0] > self.x_range[0]) and (data[:,0] < self.x_range[1])
-        y_mask = (data[:,1] > self.y_range[0]) and (data[:,1] < self.y_range[1])
-        z_mask = (data[:,2] > self.z_range[0]) and (data[:,2] < self.z_range[1])
-        mask = x_mask & y_mask & z_mask
+        mask = (data[:,0] > self.x_range[0]) & (data[:,0] < self.x_range[1])
+        mask &= (data[:,1] > self.y_range[0]) & (data[:,1] < self.y_range[1])
+        mask &= (data[:,2] > self.z_range[0]) & (data[:,2] < self.z_range[1])
 
         # apply inversion if required
         if self.inverse:
             mask = np.invert(mask)
+        return mask
+
+    def clip(self, data):
+        return data[self.mask(data)]
 
-        return data[mask]
+    def polar_prefilter(self, transformer=None):
+        # prefilter of the sensor returns, see prism_prefilter
+        if self.inverse:
+            return None
+        x0, x1 = self.x_range
+        y0, y1 = self.y_range
+        return prism_prefilter([[x0, y0], [x1, y0], [x1, y1], [x0, y1]],
+            self.z_range, transformer)
 
     def get_config(self):
-        return {}
+        return {
+            "method": "cartesian",
+            "params": {
+                "x_range": list(self.x_range),
+                "y_range": list(self.y_range),
+                "z_range": list(self.z_range),
+                "inverse": self.inverse
+                }
+            }
 
 class PolygonalClipper():
     def __init__(self, polygon, z_range, inverse=False):
@@ -63,22 +158,37 @@ class PolygonalClipper():
         self.polygon = np.array(polygon)
         self.z_range = np.array(z_range)
         self.inverse = inverse
+        self.bounds = (self.polygon.min(axis=0), self.polygon.max(axis=0))
 
-    def clip(self, data):
-        # calculate mask for inliers of 2d polygon defined in XY
+    def mask(self, data):
         # calculate maskf ro inliers in z range
-        xy_mask = points_in_poly(data[:,:2], self.polygon)
         if self.z_range[0] == self.z_range[1]:
-            z_mask = np.full((data.shape[0], ), True)
+            mask = np.full((data.shape[0], ), True)
         else:
-            z_mask = (data[:,2] > self.z_range[0]) & (data[:,2] < self.z_range[1])
-        mask = xy_mask & z_mask
+            mask = (data[:,2] > self.z_range[0]) & (data[:,2] < self.z_range[1])
+
+        # calculate mask for inliers of 2d polygon defined in XY, only
+        # points within the polygon bounds need the point in polygon test
+        lo, hi = self.bounds
+        mask &= (data[:,0] >= lo[0]) & (data[:,0] <= hi[0]) & \
+            (data[:,1] >= lo[1]) & (data[:,1] <= hi[1])
+        candidates = np.flatnonzero(mask)
+        if candidates.size:
+            mask[candidates] = points_in_poly(data[candidates,:2], self.polygon)
         
         # apply inversion if required
         if self.inverse:
             mask = np.invert(mask)
+        return mask
 
-        return data[mask]
+    def clip(self, data):
+        return data[self.mask(data)]
+
+    def polar_prefilter(self, transformer=None):
+        # prefilter of the sensor returns, see prism_prefilter
+        if self.inverse:
+            return None
+        return prism_prefilter(self.polygon, self.z_range, transformer)
 
     def get_config(self):
             return {
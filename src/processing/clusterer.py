@@ -1,6 +1,10 @@
 import numpy as np
 from sklearn.cluster import AgglomerativeClustering, DBSCAN
-from scipy.spatial import ConvexHull
+from scipy.spatial import ConvexHull, cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from .dataentities import Packet
+
 class Clusterer():
     @staticmethod
     def factory(method, **kwargs):
@@ -8,16 +12,70 @@ class Clusterer():
             return NaiveClustering(**kwargs)
         elif method == "dbscan":
             return DBSCANClustering(**kwargs)
+        elif method == "range_image":
+            return RangeImageClustering(**kwargs)
+        elif method == "grid_dbscan":
+            return GridDBSCANClustering(**kwargs)
         else:
             ValueError(method)
 
+def clusters_from_labels(points, labels, min_samples=1):
+    """
+    Splits points into clusters ordered by label with a single argsort,
+    negative labels are noise
+    """
+    idx = np.flatnonzero(labels >= 0)
+    order = idx[np.argsort(labels[idx], kind="stable")]
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+
+    # all clusters of a frame share one buffer sorted by label
+    buffer = points[order]
+    starts = np.concatenate(([0], bounds))
+    stops = np.append(bounds, order.size)
+    return [Cluster(buffer, start, stop)
+        for start, stop in zip(starts.tolist(), stops.tolist())
+        if stop - start >= min_samples]
+
 class Cluster():
-    def __init__(self, points):
-        self.points = points
-        self.size = points.shape[0]
-        self.centroid = np.mean(self.points, axis=0)
+    """
+    Points of a cluster as a range of a buffer shared by all clusters of a
+    frame. Centroid, hull and boxes are computed on first access and kept,
+    so looking at the same frame again costs nothing.
+    """
+    __slots__ = ("buffer", "start", "stop", "id", "bounding_box",
+        "_centroid", "_hull", "_aabb", "_oobb")
+
+    def __init__(self, points, start=0, stop=None):
+        self.buffer = points
+        self.start = start
+        self.stop = points.shape[0] if stop is None else stop
         self.bounding_box = []
         self.id = None
+        self._centroid = None
+        self._hull = None
+        self._aabb = {}
+        self._oobb = {}
+
+    @property
+    def points(self):
+        return self.buffer[self.start:self.stop]
+
+    @property
+    def size(self):
+        return self.stop - self.start
+
+    @property
+    def centroid(self):
+        if self._centroid is None:
+            self._centroid = np.mean(self.points, axis=0)
+        return self._centroid
+
+    @property
+    def hull(self):
+        # counterclockwise indices of the convex hull of the XY projection
+        if self._hull is None:
+            self._hull = ConvexHull(self.points[:,0:2]).vertices
+        return self._hull
 
     def get_json(self):
         box = self.bounding_box
@@ -37,6 +95,11 @@ class Cluster():
         )
 
     def getAABB(self, is_3d=True):
+        if is_3d not in self._aabb:
+            self._aabb[is_3d] = self.computeAABB(is_3d)
+        return self._aabb[is_3d]
+
+    def computeAABB(self, is_3d=True):
         xmax, ymax, zmax = np.max(self.points, axis=0)
         xmin, ymin, zmin = np.min(self.points, axis=0)
 
@@ -70,12 +133,17 @@ class Cluster():
         return polygon
 
     def getOOBB(self, is_3d=True):
+        if is_3d not in self._oobb:
+            self._oobb[is_3d] = self.computeOOBB(is_3d)
+        return self._oobb[is_3d]
+
+    def computeOOBB(self, is_3d=True):
         # get convex hull of pounts projected to XY (remove z)
         xy_points = self.points[:,0:2]
-        hull = ConvexHull(xy_points)
+        vertices = self.hull
 
         # get counterclockwise indices, close the list with idx 0
-        boundary = np.vstack((xy_points[hull.vertices,:], xy_points[hull.vertices[0],:]))
+        boundary = np.vstack((xy_points[vertices,:], xy_points[vertices[0],:]))
         # compute xyHull centroid
         
         hull_c = np.mean(xy_points, axis=0)
@@ -160,13 +228,25 @@ class Cluster():
         return translated_poly[:,0:3]
 
 class NaiveClustering():
+    """
+    Hierarchical clustering with a distance threshold. Single linkage
+    clusters are the connected components of the graph of point pairs
+    closer than the threshold, found with a KD-tree in O(N log N). Average
+    and complete linkage clusters never span two such components, so they
+    are clustered one component at a time. Their distance matrix grows with
+    the square of the component, so components of more than max_component
+    points are first cut at the median of their widest axis until every
+    piece fits, clusters crossing such a cut come out split along it.
+    """
+    max_component = 3000
+
     def __init__(self, search_radius=0.1, is_xy=False,
         min_samples=20, linkage="single"):
         self.search_radius = search_radius
         self.is_xy = is_xy
         self.linkage = linkage
         self.dimensions = 2 if is_xy else 3
-        self.min_samples = min_samples # TODO: NOT USED ANYWHERE
+        self.min_samples = min_samples # minimum cluster size
         self.clusterer = AgglomerativeClustering(
             n_clusters=None, distance_threshold=search_radius,
             linkage=linkage)
@@ -183,19 +263,76 @@ class NaiveClustering():
             }
         return config
 
+    def pairs(self, data):
+        # single linkage merges clusters strictly closer than the threshold
+        pairs = cKDTree(data).query_pairs(self.search_radius, output_type="ndarray")
+        d = data[pairs[:,0]] - data[pairs[:,1]]
+        return pairs[np.sqrt(np.einsum("ij,ij->i", d, d)) < self.search_radius]
+
+    def components(self, data, pairs=None):
+        if pairs is None:
+            pairs = self.pairs(data)
+        n = data.shape[0]
+        graph = coo_matrix((np.ones(len(pairs), dtype=np.int8),
+            (pairs[:,0], pairs[:,1])), shape=(n, n))
+        return connected_components(graph, directed=False)[1]
+
+    def split(self, data, labels):
+        # cut components above max_component at the median of the widest axis
+        counts = np.bincount(labels)
+        if not np.any(counts > self.max_component):
+            return labels
+        labels = labels.copy()
+        next_label = len(counts)
+        order = np.argsort(labels, kind="stable")
+        stack = [group for group in np.split(order, np.cumsum(counts)[:-1])
+            if len(group) > self.max_component]
+        while stack:
+            group = stack.pop()
+            if len(group) <= self.max_component:
+                labels[group] = next_label
+                next_label += 1
+                continue
+            sub = data[group]
+            axis = np.argmax(sub.max(axis=0) - sub.min(axis=0))
+            half = len(group) // 2
+            part = np.argpartition(sub[:,axis], half)
+            stack += [group[part[:half]], group[part[half:]]]
+        return labels
+
+    def labels(self, points):
+        data = points[:,:self.dimensions].astype(np.float64)
+        pairs = self.pairs(data)
+        labels = self.components(data, pairs)
+        if self.linkage == "single":
+            return labels
+
+        # pieces of the cut components still connected below the threshold
+        pieces = self.split(data, labels)
+        labels = self.components(data,
+            pairs[pieces[pairs[:,0]] == pieces[pairs[:,1]]])
+
+        # cluster every piece large enough to hold a cluster on its own
+        order = np.argsort(labels, kind="stable")
+        bounds = np.flatnonzero(np.diff(labels[order])) + 1
+        labels = np.full(labels.shape, -1, dtype=np.int64)
+        next_label = 0
+        for group in np.split(order, bounds):
+            if len(group) < self.min_samples:
+                continue
+            if len(group) == 1:
+                labels[group] = next_label
+                next_label += 1
+                continue
+            sub = self.clusterer.fit_predict(data[group])
+            labels[group] = next_label + sub
+            next_label += sub.max() + 1
+        return labels
+
     def cluster(self, points):
-        clusters = []
         if points.shape[0] == 0:
-            return clusters
-        
-        labels = self.clusterer.fit_predict(points[:,:self.dimensions])
-        unique_labels = set(labels)
-
-        for k in unique_labels:
-            cluster_mask = labels == k
-            if np.sum(cluster_mask) >= self.min_samples:
-                clusters.append(Cluster(points[cluster_mask]))
-        return clusters
+            return []
+        return clusters_from_labels(points, self.labels(points), self.min_samples)
 
 class DBSCANClustering():
     def __init__(self, search_radius=0.1, is_xy=False, 
@@ -226,13 +363,281 @@ class DBSCANClustering():
             return []
 
         labels = self.clusterer.fit_predict(points[:,:self.dimensions])
-        unique_labels = set(labels)
+        return clusters_from_labels(points, labels)
+
+
+class GridDBSCANClustering():
+    """
+    DBSCAN with the same results as sklearn's for the same parameters.
+    Points are bucketed into cells a third of search_radius wide. Points
+    of a cell and of its direct neighbour cells are always within
+    search_radius of each other, so those neighbours are counted and
+    connected per cell. Point distances are only computed between cells
+    further apart, where a cell may hold non core points or the two cells
+    are not connected otherwise.
+    """
+    subdivisions = 3 # cells per search_radius
+
+    def __init__(self, search_radius=0.1, is_xy=False, min_samples=20):
+        self.search_radius = search_radius
+        self.is_xy = is_xy
+        self.dimensions = 2 if is_xy else 3
+        self.min_samples = min_samples
+
+    def get_config(self):
+        config = {
+            "method": "grid_dbscan", 
+            "params": {
+                "search_radius": self.search_radius,
+                "is_xy": self.is_xy,
+                "min_samples": self.min_samples
+                }
+            }
+        return config
+
+    def grid(self, points):
+        """
+        Returns the points sorted by cell, their order, the sorted linear
+        cell keys, the start and size of every cell run and the strides
+        """
+        k = self.subdivisions
+        data = points[:,:self.dimensions].astype(np.float64)
+
+        # linear cell keys with a k cell margin for the neighbour offsets
+        cells = np.floor(data / (self.search_radius / k)).astype(np.int64)
+        cells -= cells.min(axis=0) - k
+        sizes = cells.max(axis=0) + k + 1
+        strides = np.append(np.cumprod(sizes[::-1])[:-1][::-1], 1)
+        keys = cells @ strides
 
-        clusters = []
-        for k in unique_labels:
-            if k == -1:
+        order = np.argsort(keys, kind="stable")
+        cellKeys, cellStart, cellCount = np.unique(
+            keys[order], return_index=True, return_counts=True)
+        return data[order], order, cellKeys, cellStart, cellCount, strides
+
+    def cell_pairs(self, cellKeys, strides):
+        """
+        Returns the (a, b) pairs of occupied cells within search_radius of
+        each other, every pair once, split into the pairs whose points are
+        all within search_radius and the pairs that need a distance check
+        """
+        k = self.subdivisions
+        size = self.search_radius / k
+        n = cellKeys.size
+        found = {True: ([], []), False: ([], [])}
+
+        # one search per stencil column, the cells of a column are a
+        # contiguous run of keys along the last axis
+        dz = np.arange(-k, k + 1)
+        columns = np.array(np.meshgrid(*[dz] * (self.dimensions - 1),
+            indexing="ij")).reshape(self.dimensions - 1, -1).T
+        for column in columns:
+            base = int(column @ strides[:-1])
+            offsets = np.column_stack((np.tile(column, (dz.size, 1)), dz))
+            near = np.sqrt((np.maximum(np.abs(offsets) - 1, 0) ** 2).sum(axis=1)) * size
+            far = np.sqrt(((np.abs(offsets) + 1) ** 2).sum(axis=1)) * size
+            # half of the stencil, the other half is symmetric
+            allowed = (near <= self.search_radius) & (base + dz > 0)
+            if not allowed.any():
                 continue
-            cluster_mask = labels == k
-            clusters.append(Cluster(points[cluster_mask]))
-        return clusters
+            sure = far < self.search_radius * (1 - 1e-6)
+
+            lo, hi = dz[allowed].min(), dz[allowed].max()
+            a = np.arange(n)
+            b = np.searchsorted(cellKeys, cellKeys + base + lo)
+            while a.size:
+                valid = b < n
+                a, b = a[valid], b[valid]
+                delta = cellKeys[b] - cellKeys[a] - base
+                valid = delta <= hi
+                a, b, delta = a[valid], b[valid], delta[valid] + k
+                for flag in (True, False):
+                    pick = allowed[delta] & (sure[delta] == flag)
+                    found[flag][0].append(a[pick])
+                    found[flag][1].append(b[pick])
+                b = b + 1
+
+        empty = np.zeros((0, ), dtype=np.int64)
+        return [np.concatenate(p) if p else empty
+            for p in found[True] + found[False]]
+
+    def close_pairs(self, data, cellStart, cellCount, a, b):
+        # (i, j) point pairs of cells a and b closer than search_radius
+        total = cellCount[a] * cellCount[b]
+        pair = np.repeat(np.arange(total.size), total)
+        step = np.arange(total.sum()) - np.repeat(np.cumsum(total) - total, total)
+        i = cellStart[a][pair] + step // cellCount[b][pair]
+        j = cellStart[b][pair] + step % cellCount[b][pair]
+
+        d = data[i] - data[j]
+        close = np.einsum("ij,ij->i", d, d) <= self.search_radius ** 2
+        return i[close], j[close]
+
+    @staticmethod
+    def components(n, a, b):
+        graph = coo_matrix((np.ones(a.size, dtype=np.int8), (a, b)), shape=(n, n))
+        return connected_components(graph, directed=False)[1]
+
+    def fit(self, points):
+        # returns the labels and the mask of the core points
+        n = points.shape[0]
+        data, order, cellKeys, cellStart, cellCount, strides = self.grid(points)
+        nCells = cellKeys.size
+        pointCell = np.repeat(np.arange(nCells), cellCount)
+        sureA, sureB, checkA, checkB = self.cell_pairs(cellKeys, strides)
+
+        # every point is its own neighbour, points of cells with enough
+        # sure neighbours are core whatever their other neighbours are
+        cellNeighbours = cellCount + \
+            np.bincount(sureA, cellCount[sureB], nCells).astype(np.int64) + \
+            np.bincount(sureB, cellCount[sureA], nCells).astype(np.int64)
+        sureCore = cellNeighbours >= self.min_samples
+
+        # point distances where a cell may hold non core points
+        needed = ~(sureCore[checkA] & sureCore[checkB])
+        i, j = self.close_pairs(data, cellStart, cellCount,
+            checkA[needed], checkB[needed])
+        counts = cellNeighbours[pointCell] + \
+            np.bincount(i, minlength=n) + np.bincount(j, minlength=n)
+        core = counts >= self.min_samples
+
+        # all core points of a cell are connected, so clusters are the
+        # connected cells holding core points
+        coreCell = np.add.reduceat(core, cellStart) > 0
+        linked = coreCell[sureA] & coreCell[sureB]
+        edges = core[i] & core[j]
+        a = np.concatenate((sureA[linked], pointCell[i[edges]]))
+        b = np.concatenate((sureB[linked], pointCell[j[edges]]))
+        component = self.components(nCells, a, b)
+
+        # remaining pairs of core cells only matter if not yet connected
+        rest = ~needed
+        rest[rest] = component[checkA[rest]] != component[checkB[rest]]
+        if rest.any():
+            ci, cj = self.close_pairs(data, cellStart, cellCount,
+                checkA[rest], checkB[rest])
+            component = self.components(nCells,
+                np.concatenate((a, pointCell[ci])), np.concatenate((b, pointCell[cj])))
+
+        # clusters are numbered in the order sklearn grows them, by their
+        # lowest core point index
+        lowestInCell = np.minimum.reduceat(np.where(core, order, n), cellStart)
+        lowest = np.full((component.max() + 1, ), n, dtype=np.int64)
+        np.minimum.at(lowest, component[coreCell], lowestInCell[coreCell])
+        grown = lowest < n
+        rank = np.full(lowest.shape, -1, dtype=np.int64)
+        rank[grown] = np.argsort(np.argsort(lowest[grown]))
+        cellLabel = np.where(coreCell, rank[component], -1)
+
+        labels = np.full((n, ), -1, dtype=np.int64)
+        labels[core] = cellLabel[pointCell[core]]
+
+        # border points join the first grown cluster that reaches them
+        unreached = np.iinfo(np.int64).max
+        reach = np.where(coreCell, cellLabel, unreached)
+        cellFirst = reach.copy()
+        np.minimum.at(cellFirst, sureA, reach[sureB])
+        np.minimum.at(cellFirst, sureB, reach[sureA])
+        first = cellFirst[pointCell]
+        fromJ = ~core[i] & core[j]
+        fromI = core[i] & ~core[j]
+        np.minimum.at(first, i[fromJ], labels[j[fromJ]])
+        np.minimum.at(first, j[fromI], labels[i[fromI]])
+        border = ~core & (first < unreached)
+        labels[border] = first[border]
+
+        # back to the input order
+        outLabels = np.empty((n, ), dtype=np.int64)
+        outLabels[order] = labels
+        outCore = np.empty((n, ), dtype=bool)
+        outCore[order] = core
+        return outLabels, outCore
+
+    def cluster(self, points):
+        if points.shape[0] == 0:
+            return []
+        return clusters_from_labels(points, self.fit(points)[0])
+
+class RangeImageClustering():
+    """
+    Connected components of the organized scan. Points are mapped back to
+    the sensor and placed on the (laser, azimuth) grid, every point is
+    linked to its azimuth neighbours in its own row and in the next
+    row_span rows if they are closer than search_radius. Clustering time
+    grows near linearly with the number of points.
+    """
+    def __init__(self, search_radius=0.5, min_samples=5, row_span=2):
+        self.search_radius = search_radius
+        self.min_samples = min_samples
+        self.row_span = row_span
+        self.transformer = None
+
+        # rows ordered by elevation for nearest elevation lookup
+        sinEle = np.sin(np.deg2rad(np.sort(Packet.eleLut)))
+        self._sinEleEdges = (sinEle[1:] + sinEle[:-1]) / 2
+
+    def set_transformer(self, transformer):
+        # transformer of the points, needed to map them back to the sensor
+        self.transformer = transformer
+
+    def get_config(self):
+        config = {
+            "method": "range_image", 
+            "params": {
+                "search_radius": self.search_radius,
+                "min_samples": self.min_samples,
+                "row_span": self.row_span
+                }
+            }
+        return config
+
+    def grid(self, points):
+        # scan row by elevation and azimuth of the points in the sensor frame
+        sensor = points if self.transformer is None else \
+            self.transformer.inverse_transform(points)
+        distance = np.linalg.norm(sensor, axis=1)
+        row = np.searchsorted(self._sinEleEdges, sensor[:,2] / distance)
+        azimuth = np.arctan2(sensor[:,0], sensor[:,1]) % (2 * np.pi)
+        return row, azimuth
+
+    def cluster(self, points):
+        if points.shape[0] == 0:
+            return []
+
+        row, azimuth = self.grid(points)
+        # sort by row then azimuth, every row is a contiguous azimuth run
+        order = np.lexsort((azimuth, row))
+        row, azimuth = row[order], azimuth[order]
+        rowStart = np.searchsorted(row, np.arange(Packet.lasers + 1))
+        key = row * 2 * np.pi + azimuth # row-major azimuth key, sorted
+
+        pairs = []
+        # consecutive points of a row, the last one wraps around to the first
+        same = np.flatnonzero(row[1:] == row[:-1])
+        pairs.append((same, same + 1))
+        full = np.flatnonzero(np.diff(rowStart) > 1)
+        pairs.append((rowStart[full + 1] - 1, rowStart[full]))
+        # azimuth neighbours in the following rows, wrapping around 0
+        for span in range(1, self.row_span + 1):
+            target = row + span
+            src = np.flatnonzero(target < Packet.lasers)
+            lo, hi = rowStart[target[src]], rowStart[target[src] + 1]
+            occupied = lo < hi
+            src, lo, hi = src[occupied], lo[occupied], hi[occupied]
+            pos = np.searchsorted(key, target[src] * 2 * np.pi + azimuth[src])
+            pairs.append((src, np.where(pos > lo, pos - 1, hi - 1)))
+            pairs.append((src, np.where(pos < hi, pos, lo)))
+
+        i = np.concatenate([p[0] for p in pairs])
+        j = np.concatenate([p[1] for p in pairs])
+        sortedPoints = points[order]
+        d = sortedPoints[i] - sortedPoints[j]
+        close = np.einsum("ij,ij->i", d, d) < self.search_radius ** 2
+        n = points.shape[0]
+        graph = coo_matrix((np.ones(close.sum(), dtype=np.int8),
+            (i[close], j[close])), shape=(n, n))
+        _, sortedLabels = connected_components(graph, directed=False)
 
+        labels = np.empty((n, ), dtype=np.int64)
+        labels[order] = sortedLabels
+        return clusters_from_labels(points, labels, self.min_samples)
@@ -1,4 +1,5 @@
 import numpy as np
+from . import trigtables
 
 class Packet:
     lasers = 32 # Number of lasers
@@ -16,6 +17,15 @@ class Packet:
 	 8.00,-12.00,9.33,
          -10.67,10.67])
     laserIds = np.arange(lasers)
+    # Layout of the 1206 byte UDP payload, used to decode many packets at once
+    dtype = np.dtype([
+        ("blocks", [
+            ("flag", "<u2"),
+            ("azimuth", "<u2"),
+            ("returns", [("distance", "<u2"), ("intensity", "u1")], (lasers,))],
+            (blocks,)),
+        ("timestamp", "<u4"),
+        ("factory", "<u2")])
 
     # Source for fast parsing:
     # https://stackoverflow.com/questions/36797088/speed-up-pythons-struct-unpakc
@@ -25,87 +35,74 @@ class Packet:
         self.distance = np.ndarray((Packet.blocks,Packet.lasers),'<H', packet, 4, (100,3))*0.002
         self.intensity = np.ndarray((Packet.blocks,Packet.lasers),'<B', packet, 6, (100,3))
 
-    def getFirings(self):
-        i = 0
-        while i < Packet.blocks:
-            yield LaserFiring(Packet.laserIds,
-                              Packet.eleLut,
-                              self.azimuth[i],
-                              self.distance[i],
-                              self.intensity[i])
-            i += 1
-        
-class LaserFiring:
-    def __init__(self, id, elevation, azimuth, distance, intensity):
-        self.id = id
-        self.elevation = elevation
-        self.azimuth = azimuth
-        self.distance = distance
-        self.intensity = intensity
-
 class Frame:
-    def __init__(self):
-        size = 70000
-        self.id = np.zeros(size)
-        self.elevation = np.zeros(size)
-        self.azimuth = np.zeros(size)
-        self.distance = np.zeros(size)
-        self.intensity = np.zeros(size)
-        self.i = 0 # Current index
-        self.x = None
-        self.y = None
-        self.z = None
-        self.aziRad = None
-        self.eleRad = None
-
-    def radiansCheck(self):
-        if(self.aziRad is None):
-            self.aziRad = np.deg2rad(self.azimuth)
-        if(self.eleRad is None):
-            self.eleRad = np.deg2rad(self.elevation)
-        
-    def getXs(self):
-        self.radiansCheck()
-        if(self.x is None):
-            self.x = (self.distance * np.cos(self.eleRad) * np.sin(self.aziRad)).flatten()
-        return self.x
-    
-    def getYs(self):
-        self.radiansCheck()
-        if(self.y is None):
-            self.y = (self.distance * np.cos(self.eleRad) * np.cos(self.aziRad)).flatten()
-        return self.y
-    
-    def getZs(self):
-        self.radiansCheck()
-        if(self.z is None):
-            self.z = (self.distance * np.sin(self.eleRad)).flatten()
-        return self.z
-
-    def getCartesian(self):
-        self.radiansCheck()
-        x = (self.distance * np.cos(self.eleRad) * np.sin(self.aziRad)).flatten()
-        y = (self.distance * np.cos(self.eleRad) * np.cos(self.aziRad)).flatten()
-        z = (self.distance * np.sin(self.eleRad)).flatten()
-        return x,y,z
-
-    def append(self,firing):
-        nextI = self.i + Packet.lasers
-        self.id[self.i:nextI] = firing.id
-        self.elevation[self.i:nextI] = firing.elevation
-        self.azimuth[self.i:nextI] = firing.azimuth
-        self.distance[self.i:nextI] = firing.distance
-        self.intensity[self.i:nextI] = firing.intensity
-        self.i = nextI
-        return self
-
-    def finalize(self):
-        self.id = self.id[:self.i]
-        self.elevation = self.elevation[:self.i]
-        self.azimuth = self.azimuth[:self.i]
-        self.distance = self.distance[:self.i]
-        self.intensity = self.intensity[:self.i]
-        return self
+    size = 70000 # Maximum number of points in a frame
+    distanceScale = 0.002 # Raw distance unit in meters
+
+    def __init__(self, laser=None, azimuth=None, distance=None, intensity=None):
+        # Points are kept in raw sensor units, spherical and cartesian
+        # coordinates are computed on demand
+        self.laser = np.zeros((0,), np.uint8) if laser is None \
+            else np.asarray(laser, np.uint8)
+        self.rawAzimuth = np.zeros((0,), np.uint16) if azimuth is None \
+            else np.asarray(azimuth, np.uint16)
+        self.rawDistance = np.zeros((0,), np.uint16) if distance is None \
+            else np.asarray(distance, np.uint16)
+        self.intensity = np.zeros((0,), np.uint8) if intensity is None \
+            else np.asarray(intensity, np.uint8)
+
+    def __len__(self):
+        return self.laser.shape[0]
+
+    @property
+    def id(self):
+        return self.laser
+
+    @property
+    def elevation(self):
+        return Packet.eleLut[self.laser]
+
+    @property
+    def azimuth(self):
+        return self.rawAzimuth / 100
+
+    @property
+    def distance(self):
+        return self.rawDistance * Frame.distanceScale
+
+    @property
+    def aziRad(self):
+        return np.deg2rad(self.azimuth)
+
+    @property
+    def eleRad(self):
+        return np.deg2rad(self.elevation)
+
+    def getXs(self, dtype=np.float64):
+        return self.getCartesian(dtype)[0]
+
+    def getYs(self, dtype=np.float64):
+        return self.getCartesian(dtype)[1]
+
+    def getZs(self, dtype=np.float64):
+        return self.getCartesian(dtype)[2]
+
+    def getCartesian(self, dtype=np.float64):
+        return trigtables.spherical_to_cartesian(
+            self.laser, self.rawAzimuth, self.rawDistance, dtype)
+
+    @staticmethod
+    def fromFirings(azimuth, distance, intensity):
+        """
+        Build a frame from raw firing arrays, azimuth of shape (n,)
+        in hundredths of degree, distance and intensity of shape (n, 32)
+        """
+        n = azimuth.shape[0] * Packet.lasers
+        return Frame(
+            laser=np.tile(Packet.laserIds.astype(np.uint8), azimuth.shape[0]),
+            azimuth=np.repeat(azimuth, Packet.lasers),
+            distance=distance.reshape(n),
+            intensity=intensity.reshape(n))
 
     def save_csv(self, filename):
         # stack everything and save as CSV
@@ -118,11 +115,50 @@ class Frame:
     def load_csv(self, filename):
         with open(filename, "r") as read_file:
             i, elev, az, dist, ints = np.loadtxt(
-            read_file, delimiter=None, skiprows=1, unpack=True, max_rows=70000)
-
-        self.id = i
-        self.elevation = elev
-        self.azimuth = az
-        self.distance = dist
-        self.intensity = ints
-        self.radiansCheck()
\ No newline at end of file
+            read_file, delimiter=None, skiprows=1, unpack=True, max_rows=Frame.size)
+
+        # elevation is implied by the laser id
+        self.laser = i.astype(np.uint8)
+        self.rawAzimuth = np.round(az * 100).astype(np.uint16)
+        self.rawDistance = np.round(dist / Frame.distanceScale).astype(np.uint16)
+        self.intensity = ints.astype(np.uint8)
+
+class PointBuffer:
+    """
+    Ragged list of (n, 3) float32 point arrays stored back to back in large
+    preallocated blocks, items are read-only views into the blocks
+    """
+    def __init__(self, block_size=2**21):
+        self.block_size = block_size
+        self.blocks = []
+        self.items = [] # (block, start, end) of every item
+        self.used = 0 # points used in the last block
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        b, start, end = self.items[i]
+        view = self.blocks[b][start:end]
+        view.flags.writeable = False
+        return view
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, arr):
+        n = arr.shape[0]
+        if not self.blocks or self.used + n > self.blocks[-1].shape[0]:
+            # start a new block, existing views are never invalidated
+            self.blocks.append(
+                np.empty((max(n, self.block_size), 3), dtype=np.float32))
+            self.used = 0
+        self.blocks[-1][self.used:self.used + n] = arr
+        self.items.append((len(self.blocks) - 1, self.used, self.used + n))
+        self.used += n
+
+    def clear(self):
+        self.blocks = []
+        self.items = []
+        self.used = 0
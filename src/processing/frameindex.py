@@ -0,0 +1,90 @@
+import os
+import numpy as np
+from .dataentities import Packet
+from .pcapreader import MmapPcapReader
+
+class FrameIndex:
+    """
+    Maps frame number to the byte offset of the pcap record where the
+    frame starts, the firing within that packet where it starts, the frame
+    timestamp and the number of packets it spans
+    """
+    version = 1
+
+    def __init__(self, offsets, firings, timestamps, packet_counts):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.firings = np.asarray(firings, dtype=np.uint8)
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.packet_counts = np.asarray(packet_counts, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @staticmethod
+    def from_reader(reader, batch_size=1000):
+        offsets, timestamps = reader.build_index()
+
+        # global firing index where every frame ends, same wrap rule as
+        # FrameAssembler
+        wraps = []
+        last = -1
+        for run in MmapPcapReader.runs(offsets, batch_size):
+            packets = reader.packets(offsets[run])
+            azimuth = packets["blocks"]["azimuth"].reshape(-1).astype(np.int32)
+            wraps.append(np.flatnonzero(np.diff(azimuth, prepend=last) < 0)
+                + run.start * Packet.blocks)
+            last = azimuth[-1]
+        ends = np.concatenate(wraps) if wraps else np.zeros((0,), np.int64)
+        starts = np.concatenate(([0], ends[:-1])).astype(np.int64)
+
+        start_pkt, start_firing = np.divmod(starts, Packet.blocks)
+        end_pkt, end_firing = np.divmod(ends, Packet.blocks)
+        record_skip = MmapPcapReader.record_size + MmapPcapReader.payload_skip
+        return FrameIndex(
+            offsets[start_pkt] - record_skip,
+            start_firing,
+            timestamps[end_pkt],
+            end_pkt - start_pkt + (end_firing > 0))
+
+    @staticmethod
+    def sidecar_path(pcap_file):
+        return pcap_file + ".idx.npz"
+
+    @staticmethod
+    def _file_key(pcap_file):
+        stat = os.stat(pcap_file)
+        return np.array([FrameIndex.version, stat.st_size, stat.st_mtime_ns],
+            dtype=np.int64)
+
+    def save(self, pcap_file):
+        try:
+            with open(FrameIndex.sidecar_path(pcap_file), "wb") as f:
+                np.savez(f,
+                    key=FrameIndex._file_key(pcap_file),
+                    offsets=self.offsets,
+                    firings=self.firings,
+                    timestamps=self.timestamps,
+                    packet_counts=self.packet_counts)
+        except OSError:
+            # read only location, index is rebuilt next time
+            return False
+        return True
+
+    @staticmethod
+    def load(pcap_file):
+        """
+        Returns the saved index of the pcap file or None if it is missing
+        or was built for a different version of the file
+        """
+        path = FrameIndex.sidecar_path(pcap_file)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with np.load(path) as data:
+                if not np.array_equal(data["key"], FrameIndex._file_key(pcap_file)):
+                    return None
+                return FrameIndex(data["offsets"], data["firings"],
+                    data["timestamps"], data["packet_counts"])
+        except (OSError, KeyError, ValueError):
+            return None
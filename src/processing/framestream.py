@@ -1,57 +1,93 @@
-from threading import Thread
-import sys
-from queue import Queue
-from .pcapframeparser import PcapFrameParser
+from threading import Thread, Event
+from queue import Queue, Full, Empty
 
 class FrameStream:
+    """
+    Prefetches items of a generator on a background thread into a bounded
+    queue. The producer blocks while the queue is full, the end of the
+    stream is signalled with a sentinel and errors of the producer are
+    re-raised to the consumer.
+
+        with FrameStream(parser.generator(), queueSize=10) as stream:
+            for ts, frame in stream:
+                ...
+    """
+    _END = object() # end of stream sentinel
+
     def __init__(self, stream, queueSize=10):
-        # initialize the file stream along with the boolean
-        # used to indicate if the thread should be stopped or not
         self.stream = stream # frame generator
-        self.stopped = False
- 
-        # initialize the queue used to store frames read from
-        # the video file
         self.Q = Queue(maxsize=queueSize)
+        self._stopped = Event()
+        self._finished = False
+        self._error = None
+        self._thread = None
 
     def start(self):
-        # start a thread to read frames from the file video stream
-        t = Thread(target=self.update, args=())
-        t.daemon = True
-        t.start()
+        # start a thread to read frames from the generator
+        if self._thread is None:
+            self._thread = Thread(target=self.update, args=())
+            self._thread.daemon = True
+            self._thread.start()
         return self
 
     def update(self):
-        # keep looping infinitely
-        while True:
-            # if the thread indicator variable is set, stop the
-            # thread
-            if self.stopped:
-                return
- 
-            # otherwise, ensure the queue has room in it
-            if not self.Q.full():
-                # try read the next frame from the file,
-                # if nothing left, return
-                try:
-                    frame = next(self.stream)
-                except StopIteration:
-                    self.stop()
+        try:
+            for item in self.stream:
+                if not self._put(item):
                     return
-                self.Q.put(frame)
+        except Exception as e:
+            self._error = e
+        self._put(FrameStream._END)
+
+    def _put(self, item):
+        # blocking put that wakes up regularly to notice stop()
+        while not self._stopped.is_set():
+            try:
+                self.Q.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
 
     def read(self):
-        # return next frame in the queue
-        return self.Q.get()
+        # return next frame, blocks until the producer delivers it,
+        # None once the stream is exhausted
+        if self._finished:
+            return None
+        self.start()
+        item = self.Q.get()
+        if item is FrameStream._END:
+            self._finished = True
+            if self._error is not None:
+                raise self._error
+            return None
+        return item
 
     def more(self):
-        # return True if there are still frames in the queue
-        return self.Q.qsize() > 0
+        # return True until the end of the stream has been read
+        return not self._finished
+
+    def __iter__(self):
+        while True:
+            item = self.read()
+            if item is None and self._finished:
+                return
+            yield item
 
     def stop(self):
-        # indicate that the thread should be stopped
-        self.stopped = True
+        # stop the producer and wait for it to exit
+        self._stopped.set()
+        while True:
+            try:
+                self.Q.get_nowait()
+            except Empty:
+                break
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self._finished = True
+
+    def __enter__(self):
+        return self.start()
 
-    def preprocess(self, frame):
-        x,y,z = frame.getCartesian()
-        return (x,y,z)
\ No newline at end of file
+    def __exit__(self, *args):
+        self.stop()
@@ -4,19 +4,25 @@ import numpy as np
 import time
 import os
 from .pcapframeparser import PcapFrameParser
+from .frameindex import FrameIndex
 from .framestream import FrameStream
 from .planetranformer import PlaneTransformer
 from .cloudclipper import CloudClipper
 from .backgroundextractor import BackgroundExtractor
-from .backgroundsubtractor import BackgroundSubtractor
-from .dataentities import Frame
+from .backgroundsubtractor import BackgroundSubtractor, KDTreeSubtractor
+from .dataentities import Frame, PointBuffer
+from . import trigtables
 from .clusterer import Clusterer
 from .tracker import Tracker
+from .batchrunner import BatchRunner
 
 class LidarProcessor():
     def __init__(self):
         self.filename = None
+        self.frameIndex = None
         self._originalFrames = []
+        # zero filtered xyz of the loaded frames, converted once at load time
+        self._originalArrays = PointBuffer()
         self._timestamps = []
         self._preprocessedArrays = []
         self._preprocessedArraysTemp = []
@@ -31,12 +37,27 @@ class LidarProcessor():
         self.bg_extractor = None
         self.bg_filename = None
         self.originalBgFrame = None
+        self.originalBgArray = None
         self.preprocessedBgArray = None
 
         self.clusterer = None
         self.frameClusters = []
 
         self.tracker = None
+
+        # per stage memoized results of the loaded frames, keyed by the
+        # fingerprints of the stage and everything upstream of it
+        self._stageCache = {}
+        self._framesVersion = 0
+        self._bgVersion = 0
+        self._bgKey = None
+        self._bgIndex = None # (digest, tree) of the last background index
+        # saved background indexes are pickles, loading one from an untrusted
+        # source can run arbitrary code so they are only read on request
+        self.trustBgIndex = False
+        self._transformBuffer = np.empty((0, 3), dtype=np.float32)
+        self._prefilter = None # (stage fingerprints, polar prefilter)
+        self._trackedKey = None
     #
     # LOAD/SAVE config
     #
@@ -154,26 +175,20 @@ class LidarProcessor():
     #
     def setFilename(self, filename):
         self.filename = filename
+        self.frameIndex = None
 
-    def restartBuffering(self):
+    def restartBuffering(self, start_frame=0):
         if self.filename is None:
             return
 
-        parser = PcapFrameParser(self.filename)
-        self.frameGenerator = parser.generator()
+        parser = PcapFrameParser(self.filename, use_mmap=True,
+            frame_index=self.frameIndex)
+        self.frameGenerator = parser.generator(start_frame=start_frame)
 
     def loadNFrames(self, N):
-        self._timestamps = []
-        self._originalFrames = []
-        self._preprocessedArrays = []
+        self.resetFrameData()
         for i in range(N):
-            (ts, f) = self.readNextFrame()
-            self._timestamps.append(ts)
-            self._originalFrames.append(f)
-
-            # preprocessed frames are the cartesian xyz arrays
-            pts = self.arrayFromFrame(f)
-            self._preprocessedArrays.append(pts)
+            self.loadFrame()
 
     def readNextFrame(self):
         try:
@@ -183,13 +198,22 @@ class LidarProcessor():
         return out
 
     def peek_size(self):
-        parser = PcapFrameParser(self.filename)
-        return parser.peek_size()
+        # frame index saved next to the pcap makes counting and seeking free
+        self.frameIndex = FrameIndex.load(self.filename)
+        if self.frameIndex is None:
+            parser = PcapFrameParser(self.filename, use_mmap=True)
+            parser.peek_size()
+            self.frameIndex = parser.frameIndex
+            self.frameIndex.save(self.filename)
+        return len(self.frameIndex)
 
     # test stuff
     def resetFrameData(self):
+        self._framesVersion += 1
+        self._stageCache = {}
         self._timestamps = []
         self._originalFrames = []
+        self._originalArrays.clear()
         self._preprocessedArrays = []
 
     def loadFrame(self):
@@ -197,9 +221,9 @@ class LidarProcessor():
         self._timestamps.append(ts)
         self._originalFrames.append(f)
 
-        # preprocessed frames are the cartesian xyz arrays
-        pts = self.arrayFromFrame(f)
-        self._preprocessedArrays.append(pts)
+        # cartesian xyz arrays are cached, preprocessing starts from them
+        self._originalArrays.append(self.arrayFromFrame(f))
+        self._preprocessedArrays.append(self._originalArrays[-1])
 
     def getTimestamp(self, frameID):
         return self._timestamps[frameID]
@@ -207,12 +231,48 @@ class LidarProcessor():
     def getArray(self,frameID):
         return self._preprocessedArrays[frameID]
 
-    def arrayFromFrame(self, frame):
-        x,y,z = frame.getCartesian()
-        pts = np.vstack((x,y,z)).astype(np.float32).T
+    def arrayFromFrame(self, frame, prefilter=False):
+        # skip returns without a distance before the trig lookups,
+        # with prefilter also returns the clipper is known to drop
+        valid = frame.rawDistance != 0
+        if prefilter:
+            valid &= self.prefilterMask(frame)
+        x,y,z = trigtables.spherical_to_cartesian(frame.laser[valid],
+            frame.rawAzimuth[valid], frame.rawDistance[valid], np.float32)
+        pts = np.empty((x.shape[0], 3), dtype=np.float32)
+        pts[:,0] = x
+        pts[:,1] = y
+        pts[:,2] = z
         pts = self.removeZeros(pts)
         return pts
 
+    def polarPrefilter(self):
+        """
+        Returns the azimuth sector and largest distance of the returns
+        the clipper can keep, None if there is no such bound
+        """
+        if self.clipper is None or not hasattr(self.clipper, "polar_prefilter"):
+            return None
+        key = (self._fingerprint(self.transformer), self._fingerprint(self.clipper))
+        if self._prefilter is None or self._prefilter[0] != key:
+            self._prefilter = (key, self.clipper.polar_prefilter(self.transformer))
+        return self._prefilter[1]
+
+    def prefilterMask(self, frame):
+        prefilter = self.polarPrefilter()
+        if prefilter is None:
+            return True
+        sector, max_distance = prefilter
+        mask = frame.rawDistance <= max_distance / Frame.distanceScale
+        if sector is not None:
+            azimuth = frame.rawAzimuth % trigtables.AZIMUTH_STEPS
+            start, stop = sector[0] * 100, sector[1] * 100
+            if start <= stop:
+                mask &= (azimuth >= start) & (azimuth <= stop)
+            else:
+                mask &= (azimuth >= start) | (azimuth <= stop)
+        return mask
+
     # 
     # PREPROCESSING
     #
@@ -220,58 +280,143 @@ class LidarProcessor():
         # ensure the subtractor is initiated with the correct
         # background point cloud
         if self.originalBgFrame is not None:
-            pts = self.arrayFromFrame(self.originalBgFrame)
-            self.preprocessedBgArray = self.preprocessBg(pts)
-            if self.bg_subtractor is not None:
-                self.bg_subtractor.set_background(self.preprocessedBgArray)
+            key = (self._bgVersion,
+                self._fingerprint(self.transformer),
+                self._fingerprint(self.clipper))
+            if self._bgKey is None or self._bgKey[0] != key:
+                self.preprocessedBgArray = self.preprocessBg(self.originalBgArray)
+            # the subtractor itself is kept in the key, its id could be
+            # reused by a new subtractor once the old one is freed
+            if self.bg_subtractor is not None and (self._bgKey is None or
+                self._bgKey[0] != key or self._bgKey[1] is not self.bg_subtractor):
+                if self.bg_subtractor.sensor_space:
+                    # range image subtractors use the raw background frame
+                    self.bg_subtractor.set_background_frame(self.originalBgFrame)
+                elif hasattr(self.bg_subtractor, "set_index"):
+                    # reuse the tree if the background cloud is unchanged
+                    if self._bgIndex is not None:
+                        self.bg_subtractor.set_index(*self._bgIndex)
+                    self.bg_subtractor.set_background(self.preprocessedBgArray)
+                    self._bgIndex = self.bg_subtractor.get_index()
+                else:
+                    self.bg_subtractor.set_background(self.preprocessedBgArray)
+            self._bgKey = (key, self.bg_subtractor)
+
+    #
+    # STAGE MEMOIZATION
+    #
+    def _fingerprint(self, processor):
+        if processor is None:
+            return None
+        config = processor.get_config()
+        if not config:
+            # processors without a config can only be told apart by identity,
+            # keeping a reference stops their id from being reused
+            return (type(processor).__name__, processor)
+        return (type(processor).__name__,
+            json.dumps(config, sort_keys=True, default=str))
+
+    def _preprocessingStages(self):
+        def subtract(arr):
+            return self.bg_subtractor.subtract(arr)
+        stages = [
+            ("transform", self.transformer,
+                self.transformer.transform if self.transformer else None),
+            ("clip", self.clipper,
+                self.clipper.clip if self.clipper else None)]
+        subtraction = ("subtract", self.bg_subtractor, subtract)
+        if self.bg_subtractor is not None and self.bg_subtractor.sensor_space:
+            # sensor space subtraction runs on the untransformed points
+            return [subtraction] + stages
+        return stages + [subtraction]
+
+    def _processingStages(self):
+        stages = self._preprocessingStages()
+        if self.clusterer is not None:
+            stages.append(("cluster", self.clusterer, self.clusterer.cluster))
+        return stages
+
+    def _prepareStageCache(self, stages):
+        # drop memoized results of every stage whose chain of configs changed
+        key = (self._framesVersion,)
+        for name, processor, _ in stages:
+            fingerprint = self._fingerprint(processor)
+            if name == "subtract" and processor is not None:
+                fingerprint = (fingerprint, self._bgVersion)
+            key = key + (fingerprint,)
+            cached = self._stageCache.get(name)
+            if cached is None or cached[0] != key:
+                self._stageCache[name] = (key, [None] * len(self._originalArrays))
+        return key
+
+    def _runStages(self, i, stages):
+        # resume from the deepest stage already computed for frame i
+        pts = self._originalArrays[i]
+        start = 0
+        for k in range(len(stages) - 1, -1, -1):
+            result = self._stageCache[stages[k][0]][1][i]
+            if result is not None:
+                pts = result
+                start = k + 1
+                break
+
+        for name, processor, fn in stages[start:]:
+            if processor is not None:
+                pts = fn(pts)
+            self._stageCache[name][1][i] = pts
+        return pts
 
     def updatePreprocessedGen(self):
         self.updateBackground()
-        # update preprocessed points
+        # update preprocessed points, only stages downstream of a change run
+        stages = self._preprocessingStages()
+        self._prepareStageCache(stages)
         self._preprocessedArrays = []
-        for (i, frame) in enumerate(self._originalFrames):
-            pts = self.arrayFromFrame(frame)
-            pts = self.preprocessArray(pts)
+        for i in range(len(self._originalArrays)):
+            pts = self._runStages(i, stages)
             self._preprocessedArrays.append(pts)
 
             # yield completion status
             yield (i+1)*100/(len(self._originalFrames))
 
     def updatePreprocessed(self):
-        self.updateBackground()
-
-        # update preprocessed points
-        self._preprocessedArrays = []
-        for (i, frame) in enumerate(self._originalFrames):
-            pts = self.arrayFromFrame(frame)
-            pts = self.preprocessArray(pts)
-            self._preprocessedArrays.append(pts)
+        for _ in self.updatePreprocessedGen():
+            pass
 
     def preprocessArray(self, arr):
-        # apply transformer
-        if self.transformer is not None:
-            arr = self.transformer.transform(arr)
-            
-        # apply clipper
-        if self.clipper is not None:
-            arr = self.clipper.clip(arr)
+        # apply sensor space bg subtractor
+        sensor_space = self.bg_subtractor is not None and \
+            self.bg_subtractor.sensor_space
+        if sensor_space:
+            arr = self.bg_subtractor.subtract(arr)
+
+        # apply transformer and clipper
+        arr = self.transformClip(arr)
 
         # apply bg subtractor
-        if self.bg_subtractor is not None:
+        if self.bg_subtractor is not None and not sensor_space:
             arr = self.bg_subtractor.subtract(arr)
 
         return arr
 
     def preprocessBg(self, arr):
-        # apply transformer
-        if self.transformer is not None:
-            arr = self.transformer.transform(arr)
-            
-        # apply clipper
-        if self.clipper is not None:
-            arr = self.clipper.clip(arr)
-
-        return arr
+        return self.transformClip(arr)
+
+    def transformClip(self, arr):
+        """
+        Transforms and clips points in one pass, the transform writes
+        into a reused buffer and only the clipped points are copied out
+        """
+        if self.transformer is None:
+            return self.clipper.clip(arr) if self.clipper is not None else arr
+        if self.clipper is None:
+            return self.transformer.transform(arr)
+
+        n = len(arr)
+        if self._transformBuffer.shape[0] < n:
+            self._transformBuffer = np.empty((max(n, Frame.size), 3), dtype=np.float32)
+        buf = self.transformer.transform(arr, out=self._transformBuffer[:n])
+        return buf[self.clipper.mask(buf)]
 
     def removeZeros(self, arr):
         return arr[np.all(arr, axis=1)]
@@ -280,6 +425,7 @@ class LidarProcessor():
     #
     def destroyTransformer(self):
         self.transformer = None
+        self.bindTransformer()
 
     def createTransformer(self, points=None, **kwargs):
             if points is not None:
@@ -290,6 +436,13 @@ class LidarProcessor():
                     kwargs["normal"], kwargs["intercept"])
             else:
                 ValueError("")
+            self.bindTransformer()
+
+    def bindTransformer(self):
+        # clusterers working on the scan grid map points back to the sensor
+        if self.clusterer is not None and \
+            hasattr(self.clusterer, "set_transformer"):
+            self.clusterer.set_transformer(self.transformer)
 
     def getPlaneCoeff(self):
         return self.transformer.get_plane_coeff()
@@ -311,27 +464,62 @@ class LidarProcessor():
             self.originalBgFrame.save_csv(filename)
             self.bg_filename = filename
 
+            # persist the spatial index of the preprocessed background
+            if self.bg_subtractor is not None and \
+                hasattr(self.bg_subtractor, "save_index"):
+                self.updateBackground()
+                self.bg_subtractor.save_index(filename)
+
     def loadBackground(self, filename):
         self.bg_extractor = None
         self.originalBgFrame = Frame()
         self.originalBgFrame.load_csv(filename)
+        self.originalBgArray = self.arrayFromFrame(self.originalBgFrame)
+        self._bgVersion += 1
+        self._bgIndex = None
+        if self.trustBgIndex:
+            self._bgIndex = KDTreeSubtractor.load_index(filename)
         self.bg_filename = filename
         
-        pts = self.arrayFromFrame(self.originalBgFrame)
-        self.preprocessedBgArray = self.preprocessArray(pts)
+        self.preprocessedBgArray = self.preprocessBg(self.originalBgArray)
 
     def extractBackground(self, method, **kwargs):
         self.bg_extractor = BackgroundExtractor(**kwargs)
-        self.bg_extractor.extract(self._originalFrames)
+        if method == "range_image_stream":
+            # stream the frames straight from the pcap file
+            parser = PcapFrameParser(self.filename, use_mmap=True,
+                frame_index=self.frameIndex)
+            self.bg_extractor.extract_stream(f for ts, f in parser.generator())
+        else:
+            self.bg_extractor.extract(self._originalFrames)
         self.originalBgFrame = self.bg_extractor.get_background()
+        self.originalBgArray = self.arrayFromFrame(self.originalBgFrame)
+        self._bgVersion += 1
+        self._bgIndex = None
         #
-        pts = self.arrayFromFrame(self.originalBgFrame)
-        self.preprocessedBgArray = self.preprocessArray(pts)
+        self.preprocessedBgArray = self.preprocessBg(self.originalBgArray)
 
     def destroyBgExtractor(self):
         self.bg_extractor = None
         self.originalBgFrame = None
+        self.originalBgArray = None
         self.preprocessedBgArray = None
+        self._bgVersion += 1
+        self._bgIndex = None
+
+    def isAdaptiveBackground(self):
+        return self.bg_subtractor is not None and \
+            hasattr(self.bg_subtractor, "update")
+
+    def restartBackground(self):
+        # adaptive backgrounds start every run from the initial background
+        if self.isAdaptiveBackground():
+            self.bg_subtractor.restart()
+
+    def updateBackgroundModel(self, arr):
+        # adaptive backgrounds learn from all points of every frame
+        if self.isAdaptiveBackground():
+            self.bg_subtractor.update(arr)
 
     def createBgSubtractor(self, method, **kwargs):
         if self.originalBgFrame is not None:
@@ -352,12 +540,16 @@ class LidarProcessor():
 
     def createClusterer(self, method, **kwargs):
         self.clusterer = Clusterer.factory(method, **kwargs)
+        self.bindTransformer()
         self.frameClusters = []
 
     def extractClustersGen(self):
+        self.updateBackground()
+        stages = self._processingStages()
+        self._prepareStageCache(stages)
         self.frameClusters = []
-        for i, arr in enumerate(self._preprocessedArrays):
-            clusters = self.clusterer.cluster(arr)
+        for i in range(len(self._originalArrays)):
+            clusters = self._runStages(i, stages)
             self.frameClusters.append(clusters)
             
             # yield completion status
@@ -374,21 +566,34 @@ class LidarProcessor():
         self.tracker = Tracker.factory(method, **kwargs)
 
     def trackClustersGen(self):
+        # tracking is sequential, it is only redone if the clusters of any
+        # frame or the tracker config changed
+        key = (self._stageCache.get("cluster", (None,))[0],
+            self._fingerprint(self.tracker))
+        if key[0] is not None and key == self._trackedKey:
+            yield 100
+            return
+
         self.tracker.restart()
         for i, clusters in enumerate(self.frameClusters):
-            # TODO: Guarantee that centroid is calculated on creation
-            centroids = [c.centroid for c in clusters]
-            self.tracker.update(centroids)
-
-            mapping = self.tracker.getInputMapping()
-            for j, c in enumerate(clusters):
-                c.id = mapping[j]
+            self.trackClusters(clusters)
 
             # yield completion status
             yield (i+1)*100/(len(self._originalFrames))
+        self._trackedKey = key
+
+    def trackClusters(self, clusters):
+        # TODO: Guarantee that centroid is calculated on creation
+        centroids = [c.centroid for c in clusters]
+        self.tracker.update(centroids)
+
+        mapping = self.tracker.getInputMapping()
+        for j, c in enumerate(clusters):
+            c.id = mapping[j]
 
     def destroyTracker(self):
         self.tracker = None
+        self._trackedKey = None
         for clusters in self.frameClusters:
             for c in clusters:
                 c.id = None
@@ -410,61 +615,95 @@ class LidarProcessor():
 
     def updateProcessingGen(self):
         self.updateBackground()
-        # update preprocessed points
+        # update preprocessed points and clusters, memoized stages whose
+        # config did not change are reused
+        preprocessing = self._preprocessingStages()
+        stages = self._processingStages()
+        self._prepareStageCache(stages)
         self._preprocessedArrays = []
         self.frameClusters = []
 
-        if self.tracker:
-            self.tracker.restart()
-
-        for (i, frame) in enumerate(self._originalFrames):
-            pts = self.arrayFromFrame(frame)
-            pts = self.preprocessArray(pts)
+        for i in range(len(self._originalArrays)):
+            pts = self._runStages(i, preprocessing)
             self._preprocessedArrays.append(pts)
 
                 # apply clustering
             if self.clusterer:
-                clusters = self.clusterer.cluster(pts)
+                clusters = self._runStages(i, stages)
                 self.frameClusters.append(clusters)
 
-                # apply tracking
-            if self.tracker:
-                centroids = [c.centroid for c in clusters]
-                self.tracker.update(centroids)
-                mapping = self.tracker.getInputMapping()
-                for j, c in enumerate(clusters):
-                    c.id = mapping[j]
-
             # yield completion status
-            yield (i+1)*100/(len(self._originalFrames))
+            yield (i+1)*100/(len(self._originalFrames)) / 2
+
+        # apply tracking
+        if self.tracker and self.clusterer:
+            for p in self.trackClustersGen():
+                yield 50 + p / 2
+
+    def liveProcessingGen(self, source):
+        """
+        Runs every stage on frames of a live source such as UdpFrameSource,
+        yields frame number, time, tracked clusters and the number of
+        frames the source dropped so far
+        """
+        if self.clusterer is None or self.tracker is None:
+            return
 
-    def processingGen(self, start_frame, end_frame):
+        self.updateBackground()
+        self.restartBackground()
+        self.tracker.restart()
+        for (i, ts, frame) in source:
+            arr = self.arrayFromFrame(frame, prefilter=True)
+            pts = self.preprocessArray(arr)
+            self.updateBackgroundModel(arr)
+            clusters = self.clusterer.cluster(pts)
+            self.trackClusters(clusters)
+            yield (i, ts, clusters, source.dropped)
+
+    def stagesCopy(self):
+        # picklable processor with only the configured stages, used by
+        # the worker processes of the batch runner
+        processor = LidarProcessor()
+        processor.filename = self.filename
+        processor.frameIndex = self.frameIndex
+        processor.transformer = self.transformer
+        processor.clipper = self.clipper
+        processor.bg_subtractor = self.bg_subtractor
+        processor.clusterer = self.clusterer
+        return processor
+
+    def processingGen(self, start_frame, end_frame, workers=1, chunk_size=20):
         if self.clusterer is None or self.tracker is None:
             return
 
-        self.tracker.restart()#? or just reinit in controller
-        for i in range(0, end_frame + 1):
-            if i < start_frame:
-                continue
+        # adaptive backgrounds depend on the frame order, keep them serial
+        if workers != 1 and not self.isAdaptiveBackground():
+            runner = BatchRunner(self, workers=workers, chunk_size=chunk_size)
+            yield from runner.run(start_frame, end_frame)
+            return
 
-            (ts, frame) = self.readNextFrame()
+        self.updateBackground()
+        self.restartBackground()
+        self.tracker.restart()#? or just reinit in controller
+        self.restartBuffering(start_frame)
 
-            # apply transform, clipping, bg subtraction
-            pts = self.arrayFromFrame(frame)
-            pts = self.preprocessArray(pts)
+        # frames are decoded on a separate thread while the previous ones
+        # are processed
+        with FrameStream(self.frameGenerator, queueSize=10) as stream:
+            for i, (ts, frame) in zip(range(start_frame, end_frame + 1), stream):
+                # apply transform, clipping, bg subtraction
+                arr = self.arrayFromFrame(frame, prefilter=True)
+                pts = self.preprocessArray(arr)
+                self.updateBackgroundModel(arr)
 
-            # apply clustering
-            clusters = self.clusterer.cluster(pts)
+                # apply clustering
+                clusters = self.clusterer.cluster(pts)
 
-            # apply tracking
-            centroids = [c.centroid for c in clusters]
-            self.tracker.update(centroids)
-            mapping = self.tracker.getInputMapping()
-            for j, c in enumerate(clusters):
-                c.id = mapping[j]
+                # apply tracking
+                self.trackClusters(clusters)
 
-            # output frame number, time, tracked clusters an dprogress
-            p = (i-start_frame+1)*100/(end_frame - start_frame)
-            yield (i, ts, clusters, p)
+                # output frame number, time, tracked clusters an dprogress
+                p = (i-start_frame+1)*100/(end_frame - start_frame + 1)
+                yield (i, ts, clusters, p)
 
 
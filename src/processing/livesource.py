@@ -0,0 +1,115 @@
+import socket
+import time
+from threading import Thread, Event
+from queue import Queue, Full, Empty
+import numpy as np
+from .dataentities import Packet
+from .pcapframeparser import FrameAssembler
+
+class UdpFrameSource:
+    """
+    Listens for Velodyne payloads on a UDP port and assembles them into
+    frames with the same azimuth wrap rule as PcapFrameParser. Frames are
+    handed to the consumer through a bounded queue, when the consumer
+    falls behind the oldest queued frame is dropped and counted so the
+    latency stays bounded.
+
+        with UdpFrameSource(port=2368) as source:
+            for n, ts, frame in source:
+                ...
+    """
+    def __init__(self, host="", port=2368, queueSize=2, batch_size=12,
+        timeout=0.1, rcvbuf=4*1024*1024):
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size # packets decoded at once
+        self.timeout = timeout
+        self.rcvbuf = rcvbuf
+        self.Q = Queue(maxsize=queueSize)
+        self.frameCount = 0 # frames assembled
+        self.dropped = 0 # frames dropped because the consumer was behind
+        self.packetCount = 0
+        self._stopped = Event()
+        self._thread = None
+        self._socket = None
+
+    def start(self):
+        if self._thread is None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+            self._socket.settimeout(self.timeout)
+            self._socket.bind((self.host, self.port))
+
+            self._thread = Thread(target=self.update, args=())
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def update(self):
+        size = Packet.dtype.itemsize
+        # one spare byte lets oversized datagrams be detected and skipped
+        buffer = bytearray(self.batch_size * size + 1)
+        view = memoryview(buffer)
+        timestamps = np.zeros((self.batch_size,))
+        assembler = FrameAssembler()
+        n = 0
+        while not self._stopped.is_set():
+            try:
+                nbytes = self._socket.recv_into(view[n*size:(n+1)*size + 1])
+                if nbytes == size:
+                    timestamps[n] = time.time()
+                    n += 1
+                    self.packetCount += 1
+                flush = n == self.batch_size
+            except socket.timeout:
+                flush = n > 0
+            except OSError:
+                break
+
+            if flush:
+                # the receive buffer is reused, decode a copy of it
+                packets = np.frombuffer(buffer, Packet.dtype, count=n).copy()
+                for ts, frame in assembler.push(timestamps[:n].copy(), packets):
+                    self._offer((self.frameCount, ts, frame))
+                    self.frameCount += 1
+                n = 0
+
+    def _offer(self, item):
+        while True:
+            try:
+                self.Q.put_nowait(item)
+                return
+            except Full:
+                try:
+                    self.Q.get_nowait()
+                    self.dropped += 1
+                except Empty:
+                    pass
+
+    def read(self, timeout=None):
+        # return next (frame number, timestamp, frame), None on timeout
+        self.start()
+        try:
+            return self.Q.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def __iter__(self):
+        while not self._stopped.is_set():
+            item = self.read(timeout=self.timeout)
+            if item is not None:
+                yield item
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if self._socket is not None:
+            self._socket.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
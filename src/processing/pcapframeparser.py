@@ -1,61 +1,159 @@
 from struct import unpack
+from itertools import islice
 import dpkt
-from .dataentities import Packet,LaserFiring,Frame
+from .dataentities import Packet,Frame
+from .pcapreader import MmapPcapReader
+from .frameindex import FrameIndex
 import numpy as np
 
+class FrameAssembler:
+    """
+    Cuts a stream of decoded packet batches into frames whenever the
+    azimuth of consecutive firings wraps around
+    """
+    def __init__(self, skip=0):
+        self.lastAzi = -1
+        self.maxFirings = Frame.size // Packet.lasers
+        self.chunks = []
+        self.nFirings = 0
+        # firings at the start of the stream that belong to a previous frame
+        self.skip = skip
+
+    def push(self, timestamps, packets):
+        # flatten all firings of the batch, columns are copied once per batch
+        blocks = packets["blocks"]
+        azimuth = blocks["azimuth"].reshape(-1)
+        distance = blocks["returns"]["distance"].reshape(-1, Packet.lasers)
+        intensity = blocks["returns"]["intensity"].reshape(-1, Packet.lasers)
+
+        # firing indices where a new rotation starts
+        wraps = np.flatnonzero(
+            np.diff(azimuth.astype(np.int32), prepend=self.lastAzi) < 0)
+
+        start = 0
+        if self.skip > 0:
+            start = min(self.skip, len(azimuth))
+            wraps = wraps[wraps > start]
+            self.skip -= start
+
+        for w in wraps:
+            self._collect(azimuth, distance, intensity, start, w)
+            yield (float(timestamps[w // Packet.blocks]), self._build())
+            start = w
+        self._collect(azimuth, distance, intensity, start, len(azimuth))
+
+        if len(azimuth) > 0:
+            self.lastAzi = azimuth[-1]
+
+    def _collect(self, azimuth, distance, intensity, start, stop):
+        # firings that do not fit into a frame are dropped
+        stop = min(stop, start + self.maxFirings - self.nFirings)
+        if stop <= start:
+            return
+        self.chunks.append(
+            (azimuth[start:stop], distance[start:stop], intensity[start:stop]))
+        self.nFirings += stop - start
+
+    def _build(self):
+        if self.chunks:
+            azimuth, distance, intensity = (
+                np.concatenate(c) for c in zip(*self.chunks))
+        else:
+            azimuth = np.zeros((0,), np.uint16)
+            distance = np.zeros((0, Packet.lasers), np.uint16)
+            intensity = np.zeros((0, Packet.lasers), np.uint8)
+
+        self.chunks = []
+        self.nFirings = 0
+        return Frame.fromFirings(azimuth, distance, intensity)
+
 class PcapFrameParser:
-    def __init__(self, pcap_file):
+    def __init__(self, pcap_file, use_mmap=False, frame_index=None):
         # check if PCAP file is really .pcap
         self.pcap_file = pcap_file
-        self.packetStream = dpkt.pcap.Reader(open(self.pcap_file, 'rb'))
+        self.frameIndex = frame_index
+        self.reader = None
+        self.packetStream = None
+        if use_mmap:
+            self.reader = MmapPcapReader(self.pcap_file, port=2368)
+        else:
+            self.packetStream = dpkt.pcap.Reader(open(self.pcap_file, 'rb'))
         self.frameCount = 0
-        self.lastAzi = -1
-        self.frame = Frame()
 
     def is_correct_port(self, buffer, port=2368):
         # get destination port from the UDP header
         dport = unpack(">H",buffer[36:38])[0]
         return  dport == port
 
-    def generator(self):
+    def batches(self, batch_size=1000, offset=None):
+        """
+        Yields (timestamps, packets) where packets is a structured array
+        of up to batch_size decoded Velodyne payloads, seeking to a record
+        byte offset is only supported by the mmap reader
+        """
+        if self.reader is not None:
+            yield from self.reader.batches(batch_size, offset=offset)
+            return
+        if offset is not None:
+            raise ValueError("Seeking requires use_mmap=True")
+
+        timestamps = []
+        payloads = []
         for ts, buf in self.packetStream:
             if(len(buf) != 1248):
                 continue
             if not self.is_correct_port(buf, port=2368):
                 continue
 
-            payload = buf[42:]
-            res = Packet(payload).getFirings()
-            for firing in res:
-                # Yield complete frames and create new Frame() container
-                if(self.lastAzi > firing.azimuth[-1]):
-                    self.frame.finalize()
-                    yield (ts, self.frame)
-                    self.frame = Frame()
-
-                try: 
-                    self.frame.append(firing)
-                except:
-                    pass
-                
-                # update last seen azimuth
-                self.lastAzi = firing.azimuth[-1]
+            timestamps.append(ts)
+            payloads.append(buf[42:])
+            if len(payloads) == batch_size:
+                yield self._decode(timestamps, payloads)
+                timestamps = []
+                payloads = []
+
+        if payloads:
+            yield self._decode(timestamps, payloads)
+
+    def _decode(self, timestamps, payloads):
+        packets = np.frombuffer(b"".join(payloads), dtype=Packet.dtype)
+        return np.array(timestamps), packets
+
+    def generator(self, batch_size=1000, start_frame=0):
+        # seek straight to the first frame if it is indexed
+        if start_frame > 0 and self.frameIndex is not None \
+            and self.reader is not None:
+            if start_frame >= len(self.frameIndex):
+                return
+            offset = int(self.frameIndex.offsets[start_frame])
+            skip = int(self.frameIndex.firings[start_frame])
+            start_frame = 0
+        else:
+            offset = None
+            skip = 0
+
+        frames = self._frames(batch_size, offset, skip)
+        yield from islice(frames, start_frame, None)
+
+    def _frames(self, batch_size, offset, skip):
+        assembler = FrameAssembler(skip=skip)
+        for timestamps, packets in self.batches(batch_size, offset=offset):
+            yield from assembler.push(timestamps, packets)
 
     def peek_size(self):
+        if self.reader is not None:
+            # count frames and build their index in the same pass
+            self.frameIndex = FrameIndex.from_reader(self.reader)
+            return len(self.frameIndex)
+
         prev_max_rot = 0
         n = 0
-        for _, buffer in self.packetStream:
-            if len(buffer) != 1248:
-                continue
-
-            if not self.is_correct_port(buffer, port=2368):
-                continue
-
-            rot = np.ndarray((12,), '<H', buffer, 42+2, (100,))
-            min_rot = rot[0]
-            max_rot = rot[11]
-            if max_rot < min_rot or prev_max_rot > min_rot:
-                n += 1
-            prev_max_rot = max_rot
+        for _, packets in self.batches():
+            rot = packets["blocks"]["azimuth"]
+            min_rot = rot[:,0]
+            max_rot = rot[:,-1]
+            prev_rot = np.concatenate(([prev_max_rot], max_rot[:-1]))
+            n += np.count_nonzero((max_rot < min_rot) | (prev_rot > min_rot))
+            prev_max_rot = max_rot[-1]
 
-        return n
+        return int(n)
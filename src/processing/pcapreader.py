@@ -0,0 +1,153 @@
+import mmap
+from struct import unpack_from
+import numpy as np
+from .dataentities import Packet
+
+class MmapPcapReader:
+    """
+    Memory maps a pcap file and indexes the byte offsets of all Velodyne
+    payloads, packets are returned as numpy views over the mapped file
+    """
+    header_size = 24 # pcap global header
+    record_size = 16 # pcap record header
+    frame_size = 1248 # ethernet + ip + udp + velodyne payload
+    payload_skip = 42 # ethernet + ip + udp headers
+    scan_chunk = 65536 # most records checked at once while indexing
+    min_chunk = 256 # fewest records checked at once after an irregular one
+
+    def __init__(self, pcap_file, port=2368):
+        self.pcap_file = pcap_file
+        self.port = port
+        self._file = open(pcap_file, "rb")
+        self.buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.buffer)
+
+        if self.size < MmapPcapReader.header_size:
+            raise ValueError("Not a pcap file", pcap_file)
+
+        magic = self.buffer[:4]
+        if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+            self.endian = "<"
+        elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+            self.endian = ">"
+        else:
+            raise ValueError("Not a pcap file", pcap_file)
+        # nanosecond resolution pcaps have a different magic number
+        self.divisor = 1E9 if magic in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d") else 1E6
+
+        self.recordDtype = np.dtype([
+            ("ts_sec", self.endian + "u4"),
+            ("ts_frac", self.endian + "u4"),
+            ("incl_len", self.endian + "u4"),
+            ("orig_len", self.endian + "u4")])
+
+        # byte offsets of the valid payloads and their timestamps
+        self.offsets = None
+        self.timestamps = None
+
+    def build_index(self):
+        offsets = []
+        timestamps = []
+        for o, ts in self._scan(MmapPcapReader.header_size):
+            offsets.append(o)
+            timestamps.append(ts)
+        self.offsets = np.concatenate(offsets) if offsets else np.zeros((0,), np.int64)
+        self.timestamps = np.concatenate(timestamps) if timestamps else np.zeros((0,))
+        return self.offsets, self.timestamps
+
+    def _scan(self, offset):
+        """
+        Yields (payload_offsets, timestamps) chunks of the valid packets
+        of records starting at byte offset
+        """
+        stride = MmapPcapReader.record_size + MmapPcapReader.frame_size
+        chunk = MmapPcapReader.scan_chunk
+        while offset + MmapPcapReader.record_size <= self.size:
+            # vectorized check of a run of consecutive Velodyne sized records,
+            # the run is sized after the previous one so that records behind
+            # an irregular one, which breaks the stride, are not checked in vain
+            n = min(chunk, (self.size - offset) // stride)
+            m = 0
+            if n > 0:
+                records = np.ndarray((n,), self.recordDtype, self.buffer, offset, (stride,))
+                irregular = np.flatnonzero(records["incl_len"] != MmapPcapReader.frame_size)
+                m = irregular[0] if irregular.size > 0 else n
+                chunk = min(MmapPcapReader.scan_chunk,
+                    max(MmapPcapReader.min_chunk, 2 * m))
+            if m > 0:
+                records = records[:m]
+                ports = np.ndarray((m,), ">u2", self.buffer,
+                    offset + MmapPcapReader.record_size + 36, (stride,))
+                valid = ports == self.port
+                offsets = offset + MmapPcapReader.record_size + \
+                    MmapPcapReader.payload_skip + np.arange(m, dtype=np.int64) * stride
+                timestamps = records["ts_sec"] + records["ts_frac"] / self.divisor
+                yield offsets[valid], timestamps[valid]
+                offset += m * stride
+                continue
+
+            # single record of any other size
+            _, _, incl_len, _ = unpack_from(self.endian + "IIII", self.buffer, offset)
+            offset += MmapPcapReader.record_size + incl_len
+            if offset > self.size:
+                break
+
+    def batches(self, batch_size=1000, offset=None):
+        """
+        Yields (timestamps, packets) where packets is a structured array
+        view of up to batch_size payloads, optionally starting from the
+        record at byte offset
+        """
+        if self.offsets is not None:
+            start = 0
+            if offset is not None:
+                start = np.searchsorted(self.offsets, offset)
+            chunks = [(self.offsets[start:], self.timestamps[start:])]
+        else:
+            # without an index the file is scanned while it is read
+            if offset is None:
+                offset = MmapPcapReader.header_size
+            chunks = self._scan(offset)
+
+        for offsets, timestamps in chunks:
+            for run in MmapPcapReader.runs(offsets, batch_size):
+                yield timestamps[run], self.packets(offsets[run])
+
+    @staticmethod
+    def runs(offsets, batch_size):
+        """
+        Yields slices of up to batch_size evenly spaced payload offsets,
+        packets of each run are viewed without copying
+        """
+        stride = MmapPcapReader.record_size + MmapPcapReader.frame_size
+        breaks = np.flatnonzero(np.diff(offsets) != stride) + 1
+        bounds = [0] + breaks.tolist() + [len(offsets)]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            for i in range(start, stop, batch_size):
+                yield slice(i, min(i + batch_size, stop))
+
+    def packets(self, offsets):
+        if len(offsets) == 0:
+            return np.zeros((0,), Packet.dtype)
+
+        # evenly spaced payloads are viewed without copying
+        steps = np.diff(offsets)
+        if len(offsets) == 1 or np.all(steps == steps[0]):
+            stride = int(steps[0]) if len(offsets) > 1 else Packet.dtype.itemsize
+            return np.ndarray((len(offsets),), Packet.dtype, self.buffer,
+                int(offsets[0]), (stride,))
+
+        # otherwise gather the payloads in one go
+        raw = np.frombuffer(self.buffer, np.uint8)
+        idx = offsets[:, None] + np.arange(Packet.dtype.itemsize)
+        return raw[idx].view(Packet.dtype).reshape(-1)
+
+    def close(self):
+        self.offsets = None
+        self.timestamps = None
+        try:
+            self.buffer.close()
+        except BufferError:
+            # views over the buffer are still alive, leave it to the gc
+            pass
+        self._file.close()
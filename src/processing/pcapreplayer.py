@@ -0,0 +1,107 @@
+import socket
+import sys
+import time
+from threading import Event
+from .pcapreader import MmapPcapReader
+
+class PcapReplayer:
+    """
+    Sends the Velodyne payloads of a pcap file to a UDP socket, paced by
+    the capture timestamps at speed times real time. speed=0 sends as fast
+    as possible.
+    """
+    def __init__(self, pcap_file, host="127.0.0.1", port=2368, speed=1.0):
+        self.pcap_file = pcap_file
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.reader = MmapPcapReader(pcap_file)
+        self.reader.build_index()
+        self.sent = 0
+        self.elapsed = 0.0
+        self._stopped = Event()
+
+    def replay(self, report=None, report_interval=1.0):
+        """
+        Replays the whole file, report(stats) is called every
+        report_interval seconds. Returns the final stats.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        address = (self.host, self.port)
+        payload_size = MmapPcapReader.frame_size - MmapPcapReader.payload_skip
+        view = memoryview(self.reader.buffer)
+        offsets = self.reader.offsets
+        timestamps = self.reader.timestamps
+
+        self.sent = 0
+        start = time.perf_counter()
+        last_report = start
+        try:
+            for i in range(len(offsets)):
+                if self._stopped.is_set():
+                    break
+
+                if self.speed > 0:
+                    # wait until the packet is due relative to the first one
+                    due = start + (timestamps[i] - timestamps[0]) / self.speed
+                    delay = due - time.perf_counter()
+                    if delay > 0.001:
+                        time.sleep(delay)
+
+                o = offsets[i]
+                sock.sendto(view[o:o + payload_size], address)
+                self.sent += 1
+
+                now = time.perf_counter()
+                if report is not None and now - last_report >= report_interval:
+                    self.elapsed = now - start
+                    report(self.stats())
+                    last_report = now
+        finally:
+            self.elapsed = time.perf_counter() - start
+            view.release()
+            sock.close()
+        return self.stats()
+
+    def stats(self):
+        duration = 0.0
+        if len(self.reader.timestamps) > 1:
+            duration = float(self.reader.timestamps[-1] - self.reader.timestamps[0])
+        return {
+            "packets": self.sent,
+            "total_packets": len(self.reader.offsets),
+            "elapsed": self.elapsed,
+            "packet_rate": self.sent / self.elapsed if self.elapsed > 0 else 0.0,
+            "capture_packet_rate": (len(self.reader.offsets) - 1) / duration \
+                if duration > 0 else 0.0
+            }
+
+    def stop(self):
+        self._stopped.set()
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(
+        description="Replay Velodyne packets of a pcap file to a UDP port")
+    ap.add_argument("pcap", help="Path to the pcap file")
+    ap.add_argument("--host", default="127.0.0.1", help="Destination host")
+    ap.add_argument("-p", "--port", default=2368, type=int, help="Destination port")
+    ap.add_argument("-s", "--speed", default=1.0, type=float,
+        help="Replay speed relative to the capture, 0 for maximum speed")
+    args = ap.parse_args()
+
+    def report(stats):
+        sys.stderr.write("\rsent {} of {} packets, {:8.1f} packets/s".format(
+            stats["packets"], stats["total_packets"], stats["packet_rate"]))
+        sys.stderr.flush()
+
+    replayer = PcapReplayer(args.pcap, args.host, args.port, args.speed)
+    try:
+        stats = replayer.replay(report=report)
+    except KeyboardInterrupt:
+        stats = replayer.stats()
+    sys.stderr.write("\nSent {} packets in {:.2f} s ({:.1f} packets/s, capture rate {:.1f} packets/s)\n".format(
+        stats["packets"], stats["elapsed"], stats["packet_rate"], stats["capture_packet_rate"]))
+
+if __name__ == "__main__":
+    main()
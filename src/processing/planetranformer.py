@@ -5,6 +5,7 @@ class PlaneTransformer():
     def __init__(self, normal=None, intercept=None):
         self.normal = np.array(normal)
         self.intercept = intercept
+        self._cache = None # (plane, rotation transposed, offset)
         
     def get_plane_from_3_points(self, points):
         spoints = np.array(points)
@@ -28,18 +29,46 @@ class PlaneTransformer():
                 }
             }
 
-    def transform(self, data):
+    def get_transform(self):
+        """
+        Returns the transposed rotation matrix and the offset that map
+        points to the plane coordinates as data @ rotation + offset,
+        cached as long as the plane does not change
+        """
         if self.normal is None or self.intercept is None:
             raise ValueError("normal and intercept are not calcualted")
-            
-        # translate
-        data = np.add(data, self.intercept * self.normal)
 
-        # rotate
-        axisZ = np.array([0, 0, 1])
-        r = self.get_rotation_matrix(self.normal, axisZ)
-        data = r.apply(data).astype("float32")
-        return data
+        plane = (tuple(np.ravel(self.normal)), self.intercept)
+        if self._cache is None or self._cache[0] != plane:
+            # rotate(p + intercept * normal) = rotate(p) + rotate(intercept * normal)
+            axisZ = np.array([0, 0, 1])
+            r = self.get_rotation_matrix(self.normal, axisZ)
+            # float32 like the output, keeps the product a single sgemm
+            rotation = r.as_matrix().T.astype(np.float32)
+            offset = r.apply(self.intercept * self.normal).astype(np.float32)
+            self._cache = (plane, rotation, offset)
+        return self._cache[1], self._cache[2]
+
+    def transform(self, data, out=None):
+        """
+        Translates and rotates the points to the plane coordinates, the
+        float32 result is written to out if given
+        """
+        rotation, offset = self.get_transform()
+        if out is None:
+            out = np.empty((len(data), 3), dtype=np.float32)
+        np.matmul(data.astype(np.float32, copy=False), rotation, out=out)
+        out += offset
+        return out
+
+    def inverse_transform(self, data):
+        """
+        Maps points from the plane coordinates back to the sensor
+        coordinates
+        """
+        rotation, offset = self.get_transform()
+        data = np.asarray(data, dtype=np.float64)
+        return (data - offset) @ rotation.T.astype(np.float64)
 
     def rotate_to_new_x(self, data, vx):
         """
@@ -64,9 +93,16 @@ class PlaneTransformer():
         This function finds a rotation from quaternion
         that rotates one vector to the orientation of another
         """
-        theta = np.arccos(np.dot(fromAxis, toAxis))
+        theta = np.arccos(np.clip(np.dot(fromAxis, toAxis), -1, 1))
         rotAxis = np.cross(fromAxis, toAxis)
-        rotAxis = rotAxis / np.linalg.norm(rotAxis)
+        norm = np.linalg.norm(rotAxis)
+        if norm == 0:
+            # parallel axes, any perpendicular axis works for a half turn
+            rotAxis = np.cross(fromAxis, [1, 0, 0])
+            if np.linalg.norm(rotAxis) == 0:
+                rotAxis = np.cross(fromAxis, [0, 1, 0])
+            norm = np.linalg.norm(rotAxis)
+        rotAxis = rotAxis / norm
 
         w = np.cos(theta / 2)
         x, y, z = np.sin(theta / 2) * rotAxis
@@ -0,0 +1,38 @@
+import numpy as np
+from . import dataentities
+
+# Azimuth is reported in hundredths of degree, so a full rotation has
+# 36000 possible values and sin/cos can be looked up instead of computed
+AZIMUTH_STEPS = 36000
+
+_tables = {}
+
+def get_tables(dtype=np.float64):
+    """
+    Returns cached (cos_elevation, sin_elevation, cos_azimuth, sin_azimuth)
+    look-up tables indexed by laser id and raw azimuth
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in _tables:
+        eleRad = np.deg2rad(dataentities.Packet.eleLut)
+        aziRad = np.deg2rad(np.arange(AZIMUTH_STEPS) / 100)
+        _tables[dtype] = (
+            np.cos(eleRad).astype(dtype),
+            np.sin(eleRad).astype(dtype),
+            np.cos(aziRad).astype(dtype),
+            np.sin(aziRad).astype(dtype))
+    return _tables[dtype]
+
+def spherical_to_cartesian(laser, azimuth, distance, dtype=np.float64):
+    """
+    Converts laser ids, raw azimuth (0.01 deg) and raw distance (2 mm)
+    arrays to x, y, z arrays of the given float dtype
+    """
+    cosEle, sinEle, cosAzi, sinAzi = get_tables(dtype)
+    dtype = cosEle.dtype.type
+    distance = distance * dtype(dataentities.Frame.distanceScale)
+    planar = distance * cosEle[laser]
+    x = planar * np.take(sinAzi, azimuth, mode="wrap")
+    y = planar * np.take(cosAzi, azimuth, mode="wrap")
+    z = distance * sinEle[laser]
+    return x, y, z